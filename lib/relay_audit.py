@@ -0,0 +1,129 @@
+"""
+Per-section transfer accounting of one forward directory.
+
+Only counters are kept for every file; names are kept for the files which did
+not make it to a section, capped to a sample for the log. The complete list
+of missing files is streamed to a sidecar file of the forward directory
+instead of being held. Memory thus depends on the number of failures shown,
+not on the size of the backlog, and the end-of-run audit is linear.
+"""
+
+import logging
+import os
+
+AUDIT_SAMPLE = 100  # names kept per section, and for the quarantine, to show in the log
+MISSING_NAME = ".relay.missing"  # section<TAB>file of every file missing, rewritten each run
+
+
+class RelayAudit(object):
+    """
+    Counters of files tried, sent and missing per section.
+    """
+
+    def __init__(self, sections, sample=AUDIT_SAMPLE, missing_file=None):
+        """
+        Class initializer.
+
+        :param sections: section names of the .config.ini, one per destination
+        :param sample: number of missing / quarantined file names kept for the log
+        :param missing_file: optional file receiving the complete list of missing files
+        """
+        self.log = logging.getLogger(__name__)
+        self.sections = list(sections)
+        self.sample = sample
+        self.files = 0
+        self.tried = 0  # file x section pairs tried
+        self.sent = dict.fromkeys(self.sections, 0)
+        self.missing = dict((sect, []) for sect in self.sections)  # sample of names
+        self.missing_cnt = dict.fromkeys(self.sections, 0)
+        self.quarantined = 0
+        self.quarantine_sample = []
+        self.missing_file = missing_file
+        self._missing_out = None
+        return
+
+    def record(self, file, sent, tried=None):
+        """
+        Account for one file tried against every section, or only some of them when re-driven.
+
+        :param file: file being processed
+        :param sent: sections the file was sent to
+        :param tried: sections the file was meant for, defaults to all
+        :return: None
+        """
+        tried = self.sections if tried is None else tried
+        self.files += 1
+        self.tried += len(tried)
+        for sect in tried:
+            if sect in sent:
+                self.sent[sect] += 1
+            else:
+                self.missing_cnt[sect] += 1
+                if len(self.missing[sect]) < self.sample:
+                    self.missing[sect].append(file)
+                self._write_missing(sect, file)
+
+    def _write_missing(self, sect, file):
+        if self.missing_file is None:
+            return
+        if self._missing_out is None:
+            self._missing_out = open(self.missing_file, 'w', encoding='utf-8')
+        self._missing_out.write("{0}\t{1}\n".format(sect, file))
+
+    def close(self):
+        """
+        Close the list of missing files, or remove the one of a previous run if nothing is missing.
+
+        :return: None
+        """
+        if self._missing_out is not None:
+            self._missing_out.close()
+            self._missing_out = None
+        elif self.missing_file is not None and not any(self.missing_cnt.values()):
+            try:
+                os.unlink(self.missing_file)
+            except FileNotFoundError:
+                pass
+
+    def record_quarantined(self, files):
+        """
+        Account for files moved to the quarantine.
+
+        :param files: list of files quarantined
+        :return: None
+        """
+        self.quarantined += len(files)
+        room = self.sample - len(self.quarantine_sample)
+        if room > 0:
+            self.quarantine_sample.extend(files[:room])
+
+    def total_sent(self):
+        return sum(self.sent.values())
+
+    def expected(self):
+        return self.tried
+
+    def report(self, forward_dir):
+        """
+        Log the summary of the forward directory, and the missing files per section if any.
+
+        :param forward_dir: forward directory audited
+        :return: None
+        """
+        self.close()
+        self.log.info("For folder : {0} ".format(forward_dir))
+        self.log.info("Total {0} files sent to quarantine : {1}{2} ".format(
+            self.quarantined, self.quarantine_sample, self._more(self.quarantined, self.quarantine_sample)))
+        self.log.info("{0} out of {1} (number of files: {2} ) forwarded to YMS {3} host(s)".format(
+            self.total_sent(), self.expected(), self.files, len(self.sections)))
+        if self.expected() != self.total_sent():
+            self.log.error("Missing files in transmission ...")
+            for sect in self.sections:
+                self.log.error("For ftp/sftp connection '{0}' the missing are :  {1}{2}".format(
+                    sect, self.missing[sect], self._more(self.missing_cnt[sect], self.missing[sect])))
+            if self.missing_file is not None:
+                self.log.error("Complete list of the missing files in {0}".format(self.missing_file))
+
+    @staticmethod
+    def _more(cnt, shown):
+        return " and {0} more".format(cnt - len(shown)) if cnt > len(shown) else ""
@@ -0,0 +1,233 @@
+"""
+Adaptive number of parallel uploads per destination host (AIMD).
+
+Each host gets a RelayConcurrency controller, a semaphore whose size moves
+within [min_limit, max_limit]: it grows by one after a window of clean uploads
+which used every slot, unless the extra slot did not bring more throughput, and
+halves as soon as the host signals overload (FTP reply 421 "Too many connections",
+SFTP channel refused, timeouts). The limit which overloaded the host becomes a
+ceiling, probed again only after a while, as server limits change over the day.
+Learned limits are saved for the next run.
+"""
+
+import ftplib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+BACKOFF = 0.5  # multiplicative decrease on overload
+MIN_GAIN = 0.05  # throughput gain an extra slot must bring to be kept
+PROBE_WINDOWS = 20  # clean windows at the ceiling before probing above the limit which overloaded the host
+OVERLOAD_REPLIES = ("421",)  # FTP "service not available", e.g. too many connections
+OVERLOAD_TYPES = ("ChannelException",)  # paramiko, channel refused by the SSH server
+
+
+def is_overload(ex):
+    """
+    Tell if an exception, or one it was raised from, means the host refuses more work.
+    Only reply codes and exception types are looked at, never the message, which may hold file names.
+
+    :param ex: exception or None
+    :return: boolean
+    """
+    seen = 0
+    while ex is not None and seen < 10:
+        if signals_overload(ex):
+            return True
+        ex = ex.__cause__ or ex.__context__
+        seen += 1
+    return False
+
+
+def signals_overload(ex):
+    """
+    Tell if one exception, regardless of the ones it was raised from, means the host refuses more work.
+
+    :param ex: exception
+    :return: boolean
+    """
+    if isinstance(ex, socket.timeout):
+        return True
+    if isinstance(ex, (ftplib.error_temp, ftplib.error_reply)) and str(ex)[:3] in OVERLOAD_REPLIES:
+        return True
+    return any(cls.__name__ in OVERLOAD_TYPES for cls in type(ex).__mro__)  # without importing paramiko
+
+
+def is_clean_reply(ex):
+    """
+    Tell if an upload failed on a well-formed refusal of the server, e.g. FTP 5xx or an SFTP
+    permission status, leaving its connection usable. Any sign of a broken or desynchronised
+    connection along the chain of causes makes it unusable.
+
+    :param ex: exception of the failed upload
+    :return: boolean
+    """
+    clean = False
+    seen = 0
+    while ex is not None and seen < 10:
+        if isinstance(ex, (EOFError, ConnectionError, socket.timeout, ftplib.error_temp, ftplib.error_reply,
+                           ftplib.error_proto)):
+            return False
+        if any(cls.__name__ == "SSHException" for cls in type(ex).__mro__):  # paramiko, without importing it
+            return False
+        if isinstance(ex, (ftplib.error_perm, FileNotFoundError, PermissionError)):
+            clean = True
+        ex = ex.__cause__ or ex.__context__
+        seen += 1
+    return clean
+
+
+class RelayConcurrency(object):
+    """
+    AIMD controller of the parallel uploads to one host.
+    """
+
+    def __init__(self, host, min_limit=1, max_limit=4, limit=None):
+        """
+        Class initializer.
+
+        :param host: destination host
+        :param min_limit: lowest number of parallel uploads
+        :param max_limit: highest number of parallel uploads
+        :param limit: starting number, e.g. learned by a previous run
+        """
+        self.log = logging.getLogger(__name__)
+        self.host = host
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = min(self.max_limit, max(self.min_limit, limit or self.min_limit))
+        self.in_flight = 0
+        self.generation = 0  # bumped on each decrease
+        self.ceiling = self.max_limit  # below the limit which last overloaded the host
+        self.clean_at_ceiling = 0
+        self._cond = threading.Condition()
+        self._reset_window()
+        self.last_throughput = None  # bytes/s of the previous window
+        self.last_limit = None
+        return
+
+    def _reset_window(self):
+        self.w_start = time.monotonic()
+        self.w_done = 0
+        self.w_bytes = 0
+        self.w_busy = 0.0
+        self.w_full = False  # every slot was used during the window
+        self.w_errors = 0
+
+    def acquire(self):
+        """
+        Wait for a free upload slot.
+
+        :return: token to give back to release()
+        """
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+            if self.in_flight >= self.limit:
+                self.w_full = True
+            return self.generation
+
+    def release(self, token, seconds=0.0, nbytes=0, error=None):
+        """
+        Give back a slot and account for the upload made with it.
+
+        :param token: value returned by acquire()
+        :param seconds: duration of the upload
+        :param nbytes: size of the file uploaded, 0 if it failed
+        :param error: exception of a failed upload, or None
+        :return: None
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if error is not None and is_overload(error):
+                self._decrease(token, "overload: {0}".format(error))
+            else:
+                if error is not None:
+                    self.w_errors += 1
+                self.w_done += 1
+                self.w_bytes += nbytes
+                self.w_busy += seconds
+                if self.w_done >= max(4, 2 * self.limit):
+                    self._evaluate()
+            self._cond.notify_all()
+
+    def _decrease(self, token, reason):
+        # uploads in flight often fail together on one overload, back off once for all of them
+        if token != self.generation:
+            return
+        self.generation += 1
+        old = self.limit
+        self.ceiling = max(self.min_limit, old - 1)
+        self.clean_at_ceiling = 0
+        self.limit = max(self.min_limit, int(self.limit * BACKOFF))
+        self.last_throughput = None
+        self.last_limit = None
+        self._reset_window()
+        if self.limit != old:
+            self.log.warning("host {0}: parallel uploads {1} -> {2} ({3})".format(self.host, old, self.limit, reason))
+
+    def _evaluate(self):
+        elapsed = max(time.monotonic() - self.w_start, 1e-6)
+        throughput = self.w_bytes / elapsed
+        latency = self.w_busy / self.w_done
+        old = self.limit
+        reason = None
+        if self.w_errors:
+            reason = "hold, {0} error(s)".format(self.w_errors)
+        elif (self.last_throughput is not None and self.last_limit is not None and self.limit > self.last_limit
+              and throughput < self.last_throughput * (1 + MIN_GAIN)):
+            self.limit -= 1
+            # settle here; the probe above the ceiling decides when to try one more slot again
+            self.ceiling = self.limit
+            self.clean_at_ceiling = 0
+            reason = "no gain"
+        elif self.w_full and self.limit < self.ceiling:
+            self.limit += 1
+            reason = "clean window"
+        elif self.w_full and self.ceiling < self.max_limit:
+            self.clean_at_ceiling += 1
+            if self.clean_at_ceiling >= PROBE_WINDOWS:
+                self.ceiling += 1
+                self.clean_at_ceiling = 0
+                self.log.info("host {0}: probing up to {1} parallel uploads again".format(self.host, self.ceiling))
+        if reason and self.limit != old:
+            self.log.info("host {0}: parallel uploads {1} -> {2} ({3}, {4:.0f} B/s, {5:.3f}s per file)".format(
+                self.host, old, self.limit, reason, throughput, latency))
+        self.last_throughput = throughput
+        self.last_limit = old
+        self._reset_window()
+
+
+def load_limits(path):
+    """
+    Read the limits learned by previous runs.
+
+    :param path: state file
+    :return: dict of host to limit
+    """
+    try:
+        with open(path, 'r') as f:
+            return dict((host, int(limit)) for host, limit in json.load(f).items())
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+def save_limits(path, controllers):
+    """
+    Merge the current limits into the state file, atomically.
+
+    :param path: state file
+    :param controllers: dict of host to RelayConcurrency
+    :return: None
+    """
+    limits = load_limits(path)  # keep hosts of other relay instances
+    for host, ctl in controllers.items():
+        limits[host] = ctl.limit
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(limits, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
@@ -0,0 +1,185 @@
+"""
+Per forward directory leases, so several relay instances can share one TDS root.
+
+A lease is a small JSON file inside the forward directory, created atomically
+with O_CREAT | O_EXCL (which also holds on NFSv3+ shares).  It names its owner
+and carries a heartbeat and an expiry time; the owner refreshes it from a
+background thread while working on the folder.  A lease whose expiry has passed
+was left by a crashed worker and is reclaimed by the next instance.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+LEASE_NAME = ".tdsrelay.lease"
+RECLAIM_SUFFIX = ".reclaim"
+DEFAULT_TTL = 600  # seconds
+
+
+class RelayLease(object):
+    """
+    Lease on one forward directory.
+    """
+
+    def __init__(self, forward_dir, ttl=DEFAULT_TTL, owner=None):
+        """
+        Class initializer.
+
+        :param forward_dir: forward directory to lease
+        :param ttl: seconds a lease stays valid without a heartbeat
+        :param owner: owner id, defaults to host:pid:random
+        """
+        self.log = logging.getLogger(__name__)
+        self.forward_dir = forward_dir
+        self.lease_file = os.path.join(forward_dir, LEASE_NAME)
+        self.ttl = ttl
+        self.owner = owner or "{0}:{1}:{2}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.held = False
+        self.lost = False  # set when the heartbeat finds the lease taken over
+        self._stop = threading.Event()
+        self._thread = None
+        return
+
+    def _content(self, acquired):
+        now = time.time()
+        return json.dumps({"owner": self.owner, "acquired": acquired,
+                           "heartbeat": now, "expires": now + self.ttl})
+
+    def read(self):
+        """
+        Read the current lease file.
+
+        :return: dict of the lease, or None if there is none or it is unreadable
+        """
+        try:
+            with open(self.lease_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def acquire(self):
+        """
+        Try to take the lease, reclaiming it if expired.
+
+        :return: True if the lease is now held by this instance
+        """
+        for attempt in range(2):
+            try:
+                fd = os.open(self.lease_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if attempt == 0 and self._reclaim_expired():
+                    continue
+                return False
+            with os.fdopen(fd, 'w') as f:
+                f.write(self._content(time.time()))
+            self.held = True
+            self.lost = False
+            self._start_heartbeat()
+            self.log.info("Acquired lease {0} as {1}".format(self.lease_file, self.owner))
+            return True
+        return False
+
+    def _reclaim_expired(self):
+        """
+        Remove an expired lease. Only one instance at a time may reclaim, guarded
+        by a second O_EXCL file, so a fresh lease is never deleted by a slow peer.
+
+        :return: True if a lease was removed
+        """
+        lease = self.read()
+        if lease is not None and lease.get("expires", 0) > time.time():
+            return False
+        if lease is None and self._age(self.lease_file) < self.ttl:
+            return False  # being written right now, or torn by a crash not long ago
+
+        guard = self.lease_file + RECLAIM_SUFFIX
+        try:
+            fd = os.open(guard, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            if self._age(guard) > self.ttl:  # reclaimer crashed
+                self._unlink(guard)
+            return False
+        try:
+            os.write(fd, self.owner.encode())
+            os.close(fd)
+            # check again under the guard, the lease may have been renewed meanwhile
+            if self.read() != lease:
+                return False
+            self.log.warning("Reclaiming expired lease {0} of {1}".format(
+                self.lease_file, lease.get("owner") if lease else "unknown"))
+            self._unlink(self.lease_file)
+            return True
+        finally:
+            self._unlink(guard)
+
+    def heartbeat(self):
+        """
+        Push the expiry of a held lease forward.
+
+        :return: True if the lease is still ours
+        """
+        if not self.held:
+            return False
+        lease = self.read()
+        if lease is None or lease.get("owner") != self.owner:
+            self.log.error("Lease {0} was taken over by {1}".format(
+                self.lease_file, lease.get("owner") if lease else "unknown"))
+            self.held = False
+            self.lost = True
+            return False
+        tmp = "{0}.{1}.tmp".format(self.lease_file, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self._content(lease.get("acquired")))
+        os.replace(tmp, self.lease_file)
+        return True
+
+    def release(self):
+        """
+        Stop the heartbeat and remove the lease if it is still ours.
+
+        :return: None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.held:
+            lease = self.read()
+            if lease is not None and lease.get("owner") == self.owner:
+                self._unlink(self.lease_file)
+                self.log.info("Released lease {0}".format(self.lease_file))
+            self.held = False
+        return
+
+    def _start_heartbeat(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._beat, name="lease-heartbeat", daemon=True)
+        self._thread.start()
+
+    def _beat(self):
+        while not self._stop.wait(self.ttl / 3.0):
+            try:
+                if not self.heartbeat():
+                    return
+            except Exception as ex:
+                self.log.exception(ex)
+                self.log.error("Unable to refresh lease {0}".format(self.lease_file))
+
+    @staticmethod
+    def _age(path):
+        try:
+            return time.time() - os.stat(path).st_mtime
+        except OSError:
+            return 0
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,128 @@
+"""
+Logging setup for the relay, keeping formatting and disk writes off the transfer loop.
+
+Records are handed to a QueueHandler on the root logger and written by a
+QueueListener thread.  Per-file records (forwarding, renaming, backup, ...) go
+through file_event() at their own, lower level, so they can be switched off
+cheaply or written as compact JSON lines for large backlogs.
+"""
+
+import json
+import logging
+import logging.handlers
+import queue
+
+LOG_FMT = '%(asctime)s - %(levelname)s - %(message)s'
+
+_listener = None
+_queue_handler = None
+_file_event_level = logging.DEBUG
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Format a record as one JSON object per line.
+    """
+
+    def format(self, record):
+        doc = {"ts": self.formatTime(record), "level": record.levelname, "logger": record.name}
+        event = getattr(record, "relay_event", None)
+        if event:
+            doc.update(event)
+        else:
+            doc["msg"] = record.getMessage()
+        if record.exc_info:
+            doc["exc"] = self.formatException(record.exc_info)
+        return json.dumps(doc, default=str)
+
+
+class _RelayQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler which leaves formatting to the listener thread.
+
+    The stock prepare() formats the message in the caller's thread, which is
+    exactly the cost we want out of the transfer loop. The queue never leaves
+    the process, so the record can be passed on as-is.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(logfile, level=logging.INFO, file_event_level=logging.DEBUG, structured=False, console=True):
+    """
+    Route all logging through a queue to a background listener. Safe to call
+    more than once, later calls only adjust the levels.
+
+    :param logfile: path of the application log file
+    :param level: level of the root logger
+    :param file_event_level: level at which per-file records are emitted
+    :param structured: write JSON lines instead of plain text
+    :param console: also echo INFO and above to stderr
+    :return: None
+    """
+    global _listener, _queue_handler, _file_event_level
+    _file_event_level = file_event_level
+    root = logging.getLogger()
+    root.setLevel(level)
+    if _listener is not None:
+        return
+
+    formatter = JsonLinesFormatter() if structured else logging.Formatter(LOG_FMT)
+    handlers = []
+    fh = logging.FileHandler(logfile)
+    fh.setFormatter(formatter)
+    handlers.append(fh)
+    if console:
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.INFO)
+        ch.setFormatter(formatter)
+        handlers.append(ch)
+
+    q = queue.SimpleQueue()
+    _queue_handler = _RelayQueueHandler(q)
+    root.addHandler(_queue_handler)
+    _listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    _listener.start()
+    return
+
+
+def stop_logging():
+    """
+    Flush pending records and stop the background listener.
+
+    :return: None
+    """
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    logging.getLogger().removeHandler(_queue_handler)
+    _listener.stop()  # drains the queue before returning
+    for h in _listener.handlers:
+        h.close()
+    _listener = None
+    _queue_handler = None
+    return
+
+
+def file_event(log, event, file, **fields):
+    """
+    Emit a per-file record at the configured file event level.
+
+    Nothing is built when the level is disabled, so these calls are nearly free
+    in the transfer loop.
+
+    :param log: logger of the calling module
+    :param event: short event name, e.g. 'forward', 'rename', 'backup'
+    :param file: file being processed
+    :param fields: additional values for the record
+    :return: None
+    """
+    if not log.isEnabledFor(_file_event_level):
+        return
+    record = {"event": event, "file": file}
+    record.update(fields)
+    if fields:
+        log.log(_file_event_level, "%s %s %s", event, file, fields, extra={"relay_event": record})
+    else:
+        log.log(_file_event_level, "%s %s", event, file, extra={"relay_event": record})
@@ -0,0 +1,180 @@
+"""
+Small staged pipeline of worker threads connected by bounded queues.
+
+Used to overlap scanning/validation of a forward directory with the uploads, so
+the network does not sit idle while a large backlog is validated.  Queues are
+bounded, so memory stays flat however many files are waiting: a slow stage
+simply blocks the stage feeding it.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+_DONE = object()  # end of stream marker, one per worker
+
+
+class RelayStage(object):
+    """
+    One pipeline stage: a function run by a number of worker threads.
+
+    The function gets one item and returns the item for the next stage, or None
+    to drop it. The first stage may take a batch of items at once instead, e.g. to
+    hand them to another process together: its function gets a list of up to
+    batch items and returns the list of those to pass on. An exception aborts the whole pipeline: stages stop
+    taking new items, except a finish_on_abort stage, which still handles every
+    item already queued to it, e.g. the bookkeeping of files already uploaded.
+    """
+
+    def __init__(self, name, func, workers=1, maxsize=64, batch=None, finish_on_abort=False):
+        """
+        Class initializer.
+
+        :param name: stage name used in the metrics
+        :param func: callable processing one item
+        :param workers: number of worker threads
+        :param maxsize: depth of the inbound queue, in batches for a batch stage
+        :param batch: items per call of func, first stage only, None for one item at a time
+        :param finish_on_abort: keep handling the queued items when the pipeline aborts
+        """
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.maxsize = maxsize
+        self.batch = batch
+        self.finish_on_abort = finish_on_abort
+        self.inbox = queue.Queue(maxsize)
+
+        self.processed = 0  # items, not batches
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.busy = 0.0  # seconds spent in func, summed over workers
+        self._lock = threading.Lock()
+        return
+
+    def metrics(self):
+        return "stage {0}: workers={1} processed={2} dropped={3} errors={4} max_queue={5}/{6} busy={7:.3f}s".format(
+            self.name, self.workers, self.processed, self.dropped, self.errors, self.max_depth, self.maxsize, self.busy)
+
+
+class RelayPipeline(object):
+    """
+    Chain of RelayStage fed from an iterator.
+    """
+
+    def __init__(self, stages, name="pipeline"):
+        """
+        Class initializer.
+
+        :param stages: list of RelayStage, in processing order
+        :param name: name used in the log
+        """
+        self.log = logging.getLogger(__name__)
+        self.stages = stages
+        self.name = name
+        self.fed = 0
+        self.feed_time = 0.0
+        self.error = None
+        self._abort = threading.Event()
+        return
+
+    def run(self, source):
+        """
+        Push every item of source through the stages and wait until all are done.
+
+        :param source: iterable of items for the first stage
+        :return: None, re-raises the first exception of any stage
+        """
+        threads = []
+        for idx, stage in enumerate(self.stages):
+            nxt = self.stages[idx + 1] if idx + 1 < len(self.stages) else None
+            ts = [threading.Thread(target=self._work, args=(stage, nxt),
+                                   name="{0}-{1}-{2}".format(self.name, stage.name, i), daemon=True)
+                  for i in range(stage.workers)]
+            for t in ts:
+                t.start()
+            threads.append(ts)
+
+        try:
+            first = self.stages[0]
+            it = iter(source if first.batch is None else chunked(source, first.batch))
+            while not self._abort.is_set():
+                t1 = time.perf_counter()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    break
+                self.feed_time += time.perf_counter() - t1
+                first.inbox.put(item)
+                self.fed += 1 if first.batch is None else len(item)
+        except Exception as ex:
+            self._fail(None, ex)
+        finally:
+            # close the stages one after the other, so every queued item is drained
+            for stage, ts in zip(self.stages, threads):
+                for _ in ts:
+                    stage.inbox.put(_DONE)
+                for t in ts:
+                    t.join()
+
+        self.log.info("{0}: scan fed={1} in {2:.3f}s".format(self.name, self.fed, self.feed_time))
+        for stage in self.stages:
+            self.log.info("{0}: {1}".format(self.name, stage.metrics()))
+        if self.error is not None:
+            raise self.error
+        return
+
+    def _work(self, stage, nxt):
+        while True:
+            item = stage.inbox.get()
+            if item is _DONE:
+                break
+            if self._abort.is_set() and not stage.finish_on_abort:
+                continue  # drain only
+            depth = stage.inbox.qsize() + 1
+            t0 = time.perf_counter()
+            try:
+                out = stage.func(item)
+            except Exception as ex:
+                with stage._lock:
+                    stage.errors += 1
+                self._fail(stage, ex)
+                continue
+            if stage.batch is None:
+                (items, out) = (1, [] if out is None else [out])
+            else:
+                items = len(item)
+            with stage._lock:
+                stage.busy += time.perf_counter() - t0
+                stage.max_depth = max(stage.max_depth, depth)
+                stage.processed += len(out)
+                stage.dropped += items - len(out)
+            if nxt is not None:
+                for o in out:
+                    nxt.inbox.put(o)
+
+    def _fail(self, stage, ex):
+        if self.error is None:
+            self.error = ex
+            self.log.error("{0}: aborted in stage {1}".format(self.name, stage.name if stage else "scan"))
+        self._abort.set()
+
+
+def chunked(iterable, size):
+    """
+    Group the items of an iterable into lists of up to size items, lazily.
+
+    :param iterable: items
+    :param size: items per chunk
+    :return: generator of lists
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,292 @@
+"""
+Deferred post-actions (backup / remove / quarantine) for a forward directory.
+
+Post-actions used to run one file at a time inside the upload loop, each paying
+for a few exists()/makedirs() round trips. On NFS every call is a round trip, so
+the actions are now collected while uploading and applied in bulk afterwards:
+target folders are created once, and files are moved with a no-clobber
+os.link() and an unlink, so a name clash is found by the link itself instead of
+listing the ever growing backup folder.
+
+Crash safety: every action is appended to a journal inside the forward
+directory *before* it is considered done, a quarantine with the reason and the
+destinations missed, for the re-drive index.  If the relay dies between the
+upload and the move, the next run replays the journal first, so a file which was
+already sent is moved away instead of being left in the queue and sent again.
+Each entry is handed to the OS at once, which covers a crash of the relay; it
+is fsync'ed, a COMMIT round trip on NFS, only every JOURNAL_SYNC entries and
+before the actions are applied. A crash of the host itself may thus lose the
+last JOURNAL_SYNC - 1 entries, and those files are sent again under a -N name.
+
+A move is a link and an unlink rather than one os.replace(), the price of
+never clobbering an earlier file of the same name without listing the folder.
+"""
+
+import json
+import logging
+import os
+import shutil
+from .relay_transmission_error import incremental_file_name
+from .relay_logging import file_event
+from .relay_redrive import classify, PERMANENT
+
+BACKUP_FOLDER_NAME = 'transferred'
+QUARANTINE = "quarantined"
+JOURNAL_NAME = ".postaction.journal"
+BATCH_SIZE = 1000  # pending actions before the caller should apply them
+JOURNAL_SYNC = 100  # journal entries per fsync
+
+ACTION_BACKUP = "backup"
+ACTION_REMOVE = "remove"
+ACTION_QUARANTINE = "quarantine"
+
+
+class RelayPostActions(object):
+    """
+    Collects post-actions for one forward directory and applies them in bulk.
+    """
+
+    def __init__(self, forward_dir, redrive=None):
+        """
+        Class initializer.
+
+        :param forward_dir: forward directory the queued files live in
+        :param redrive: optional RelayRedriveIndex recording why files are quarantined
+        """
+        self.log = logging.getLogger(__name__)
+        self.forward_dir = forward_dir
+        self.journal_file = os.path.join(forward_dir, JOURNAL_NAME)
+        self.actions = {}  # file -> action, insertion ordered
+        self._journal = None
+        self._unsynced = 0  # journal entries written since the last fsync
+        self._prepared = set()  # target folders created
+        self.redrive = redrive
+        self.quarantine_info = {}  # file -> {reason, cause, missing sections}, for the re-drive index
+        return
+
+    def backup(self, file):
+        """
+        Queue file to be moved into the 'transferred' folder.
+
+        :param file: file being processed
+        :return: None
+        """
+        self._add(file, ACTION_BACKUP)
+
+    def remove(self, file):
+        """
+        Queue file to be deleted.
+
+        :param file: file being processed
+        :return: None
+        """
+        self._add(file, ACTION_REMOVE)
+
+    def quarantine(self, file, error=None, missing=None):
+        """
+        Queue file to be moved into the 'quarantined' folder. Quarantine always
+        wins over a backup/remove queued for the same file by another section.
+
+        :param file: file being processed
+        :param error: exception of the failed upload, for the re-drive index
+        :param missing: sections the file was not sent to, for the re-drive index
+        :return: None
+        """
+        info = None
+        if missing is not None:
+            info = {"reason": str(error) if error else "unknown",
+                    "cause": classify(error) if missing else PERMANENT,
+                    "missing": list(missing)}
+            self.quarantine_info[file] = info
+        self._add(file, ACTION_QUARANTINE, info)
+
+    def is_full(self):
+        """
+        Tell if enough actions are pending to be applied, keeping memory flat on large backlogs.
+        """
+        return len(self.actions) >= BATCH_SIZE
+
+    def _add(self, file, action, info=None):
+        if self.actions.get(file) == ACTION_QUARANTINE:
+            return
+        self.actions[file] = action
+        self._write_journal(action, file, info)
+
+    def _write_journal(self, action, file, info=None):
+        if self._journal is None:
+            self._journal = open(self.journal_file, 'a', encoding='utf-8')
+        line = "{0}\t{1}".format(action, file)
+        if info is not None:
+            line += "\t" + json.dumps(info)  # escapes tabs and new lines of the reason
+        self._journal.write(line + "\n")
+        self._journal.flush()
+        self._unsynced += 1
+        if self._unsynced >= JOURNAL_SYNC:
+            self._sync_journal()
+
+    def _sync_journal(self):
+        if self._journal is not None and self._unsynced:
+            os.fsync(self._journal.fileno())
+            self._unsynced = 0
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._sync_journal()  # the journal must be on disk before files move
+            self._journal.close()
+            self._journal = None
+        self._unsynced = 0  # journal entries written since the last fsync
+
+    def recover(self):
+        """
+        Replay a journal left over by an interrupted run, so files already sent
+        are moved away before the forward directory is scanned again.
+
+        :return: number of journal entries replayed
+        """
+        if not os.path.isfile(self.journal_file):
+            return 0
+        with open(self.journal_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    continue  # torn last line of a crashed write
+                action, sep, rest = line.rstrip("\n").partition("\t")
+                file, sep2, info = rest.partition("\t")
+                if not sep or not file:
+                    continue
+                if self.actions.get(file) == ACTION_QUARANTINE:
+                    continue
+                self.actions[file] = action
+                if action == ACTION_QUARANTINE and sep2:
+                    try:
+                        self.quarantine_info[file] = json.loads(info)
+                    except ValueError:
+                        pass
+        cnt = len(self.actions)
+        self.log.warning("Replaying {0} unfinished post-action(s) from {1}".format(cnt, self.journal_file))
+        self.apply()
+        return cnt
+
+    def apply(self):
+        """
+        Apply all queued actions, then drop the journal. May be called once per
+        batch, the target folders are only created the first time.
+
+        :return: tuple of (moved to backup, removed, quarantined) file lists
+        """
+        self._close_journal()
+        backed_up, removed, quarantined = [], [], []
+        if not self.actions:
+            if self.redrive is not None:
+                self.redrive.save()
+            self._drop_journal()
+            return (backed_up, removed, quarantined)
+
+        bak_dir = os.path.join(self.forward_dir, BACKUP_FOLDER_NAME)
+        quara = os.path.join(self.forward_dir, QUARANTINE)
+        wanted = set(self.actions.values())
+        if ACTION_BACKUP in wanted:
+            self._prepare_dir(bak_dir)
+        if ACTION_QUARANTINE in wanted:
+            self._prepare_dir(quara)
+
+        for file, action in self.actions.items():
+            if action == ACTION_REMOVE:
+                try:
+                    os.unlink(file)
+                    removed.append(file)
+                    file_event(self.log, "remove", file)
+                except FileNotFoundError:
+                    pass
+                except Exception as ex:
+                    self.log.exception(ex)
+                    self.log.error("Unable to remove file {0}".format(file))
+                continue
+
+            if action == ACTION_BACKUP:
+                try:
+                    if self._move(file, bak_dir):
+                        backed_up.append(file)
+                        file_event(self.log, "backup", file)
+                    continue
+                except Exception as ex:
+                    self.log.exception(ex)
+                    self.log.error("Unable to move file {0} for backup".format(file))
+                    self._prepare_dir(quara)
+
+            try:
+                name = self._move(file, quara)
+                if name:
+                    quarantined.append(file)
+                    self.log.info("moved file to quarantine: {0} to {1} ".format(file, quara))
+                    if self.redrive is not None:
+                        info = self.quarantine_info.get(file, {})
+                        self.redrive.add(name, file, info.get("reason", "unknown"), info.get("cause", PERMANENT),
+                                         info.get("missing", []))
+            except Exception as ex:
+                self.log.exception(ex)
+                self.log.error("Unable to move file {0} to quarantine".format(file))
+
+        if backed_up:
+            self.log.info("Backup {0} data file(s) under {1}".format(len(backed_up), bak_dir))
+        if removed:
+            self.log.info("Removed {0} data file(s)".format(len(removed)))
+        self.actions.clear()
+        self.quarantine_info.clear()
+        if self.redrive is not None:
+            self.redrive.save()
+        self._drop_journal()
+        return (backed_up, removed, quarantined)
+
+    def _prepare_dir(self, target):
+        """
+        Create target folder, once.
+        """
+        if target not in self._prepared:
+            os.makedirs(target, exist_ok=True)
+            self._prepared.add(target)
+
+    def _move(self, file, target):
+        """
+        Move file into target without clobbering an earlier file of the same name.
+
+        :return: name of the file in target, None if the source had already gone
+        """
+        bfn = os.path.basename(file)
+        while True:
+            dest = os.path.join(target, bfn)
+            try:
+                os.link(file, dest)  # fails instead of replacing an existing file
+            except FileExistsError:
+                bfn = incremental_file_name(bfn)
+                continue
+            except FileNotFoundError:
+                return None
+            except OSError:
+                # no hard links here, e.g. another filesystem or a share: look for a clash, then move
+                if not os.path.exists(file):
+                    return None
+                if os.path.exists(dest):
+                    bfn = incremental_file_name(bfn)
+                    continue
+                self._replace(file, dest)
+                return bfn
+            try:
+                os.unlink(file)
+            except FileNotFoundError:
+                pass
+            return bfn
+
+    @staticmethod
+    def _replace(file, dest):
+        try:
+            os.replace(file, dest)
+        except OSError:
+            # e.g. EXDEV if the folder is a mount point of its own
+            shutil.move(file, dest)
+
+    def _drop_journal(self):
+        try:
+            os.unlink(self.journal_file)
+        except FileNotFoundError:
+            pass
+        return
@@ -0,0 +1,211 @@
+"""
+Detection of the files of a forward directory which are completely written.
+
+Instead of waiting a fixed delay after the last modification, a file is
+released as soon as it is provably complete:
+
+- a .tmp file is still being written, writers rename it when done; with
+  tmp_rename every other file is complete as soon as it shows up;
+- a zip (.dat envelope) is written sequentially and ends with its
+  end-of-central-directory record, so it is complete once the record
+  closes the file; one left unchanged without it for STALL seconds over
+  STALL_OBSERVATIONS scans is passed on with a warning, so that validation
+  reports it rather than holding it forever;
+- any other file is complete once its (size, mtime_ns) did not change
+  between two observations, e.g. two runs of the relay, some seconds apart;
+- a file older than max_wait is released as before.
+
+Whatever the rule, a file still locked by its writer is held back. The
+observations are kept in memory, and in a small state file of the forward
+directory for the next run.
+"""
+
+import json
+import logging
+import os
+import struct
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+STATE_NAME = ".readiness.json"
+SETTLE = 2  # seconds between two observations of an unchanged file
+STALL = 600  # seconds an incomplete zip stays unchanged before it is passed on anyway
+STALL_OBSERVATIONS = 3
+ZIP_SUFFIXES = (".dat", ".zip")
+EOCD_SIGNATURE = b"PK\x05\x06"
+EOCD_SIZE = 22
+EOCD_MAX = EOCD_SIZE + 0xFFFF  # the record ends with a comment of up to 64KiB
+
+
+def zip_complete(path, size):
+    """
+    Tell if a zip file ends with its end-of-central-directory record.
+
+    :param path: file being processed
+    :param size: size of the file
+    :return: boolean
+    """
+    tail = min(size, EOCD_MAX)
+    if tail < EOCD_SIZE:
+        return False
+    with open(path, 'rb') as f:
+        f.seek(size - tail)
+        data = f.read(tail)
+    pos = data.rfind(EOCD_SIGNATURE)
+    while pos >= 0:
+        if pos + EOCD_SIZE <= len(data):
+            (comment_len,) = struct.unpack("<H", data[pos + 20:pos + EOCD_SIZE])
+            if pos + EOCD_SIZE + comment_len == len(data):
+                return True
+        pos = data.rfind(EOCD_SIGNATURE, 0, pos)
+    return False
+
+
+def is_locked(path):
+    """
+    Non-blocking probe of a lock held on a file by its writer.
+
+    :param path: file being processed
+    :return: True if another process holds a conflicting lock
+    """
+    if fcntl is not None:
+        with open(path, 'rb') as f:
+            for lock in (fcntl.flock, fcntl.lockf):  # independent kinds of locks on Linux
+                try:
+                    lock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except OSError:
+                    return True
+                lock(f, fcntl.LOCK_UN)
+        return False
+    if not os.access(path, os.W_OK):
+        return False  # read-only, nobody writes it
+    try:
+        # Windows refuses to open a file its writer did not share for writing
+        with open(path, 'ab'):
+            pass
+    except PermissionError:
+        return True
+    return False
+
+
+class RelayReadiness(object):
+    """
+    Observations of the files of one forward directory.
+    """
+
+    def __init__(self, forward_dir, max_wait=120, tmp_rename=False, settle=SETTLE, stall=STALL):
+        """
+        Class initializer.
+
+        :param forward_dir: forward directory observed
+        :param max_wait: age in seconds after which a file is released anyway, 0 never
+        :param tmp_rename: writers produce files as .tmp and rename them when done
+        :param settle: seconds between two observations of an unchanged file
+        :param stall: seconds an incomplete zip stays unchanged before it is passed on anyway
+        """
+        self.log = logging.getLogger(__name__)
+        self.forward_dir = forward_dir
+        self.state_file = os.path.join(forward_dir, STATE_NAME)
+        self.max_wait = max_wait
+        self.tmp_rename = tmp_rename
+        self.settle = settle
+        self.stall = stall
+        self.observed = None  # name -> [size, mtime_ns, first observed at, observations], loaded on first use
+        self.seen = {}  # observations of the current scan
+        self.dirty = False
+        return
+
+    def load(self):
+        if self.observed is None:
+            try:
+                with open(self.state_file, 'r') as f:
+                    self.observed = json.load(f)
+            except FileNotFoundError:
+                self.observed = {}
+            except (OSError, ValueError) as ex:
+                self.log.exception(ex)
+                self.log.error("Unable to read readiness state {0}, starting a new one".format(self.state_file))
+                self.observed = {}
+        return self.observed
+
+    def save(self):
+        """
+        Write the observations if they changed, atomically.
+
+        :return: None
+        """
+        if not self.dirty:
+            return
+        tmp = "{0}.{1}.tmp".format(self.state_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.observed, f)
+        os.replace(tmp, self.state_file)
+        self.dirty = False
+
+    def begin(self):
+        """
+        Start of a scan, dropping what a scan aborted midway saw.
+
+        :return: None
+        """
+        self.seen = {}
+
+    def check(self, entry, now=None):
+        """
+        Tell if a file of the forward directory is completely written.
+
+        :param entry: os.DirEntry of the file
+        :param now: time to compare with, defaults to time.time()
+        :return: tuple of (ready, reason)
+        """
+        observed = self.load()
+        now = time.time() if now is None else now
+        name = entry.name
+        if name.endswith(".tmp"):
+            return (False, "tmp")
+        st = entry.stat()
+        current = [st.st_size, st.st_mtime_ns]
+        previous = observed.get(name)
+        unchanged = previous is not None and previous[:2] == current
+        count = (previous[3] if len(previous) > 3 else 1) + 1 if unchanged else 1
+
+        if self.tmp_rename:
+            reason = "renamed"
+        elif self.max_wait and now - st.st_mtime >= self.max_wait:
+            reason = "age"
+        elif name.endswith(ZIP_SUFFIXES):
+            # a pause of the writer must not release half a zip, only a long stall does
+            if zip_complete(entry.path, st.st_size):
+                reason = "zip_complete"
+            elif unchanged and count >= STALL_OBSERVATIONS and now - previous[2] >= self.stall:
+                reason = "stalled"
+                self.log.warning("Passing on {0}, unchanged for {1:.0f}s without a complete zip record".format(
+                    entry.path, now - previous[2]))
+            else:
+                reason = None
+        elif unchanged and now - previous[2] >= self.settle:
+            reason = "stable"
+        else:
+            reason = None
+
+        hold = "changing" if reason is None else "locked" if is_locked(entry.path) else None
+        if hold is not None:
+            # keep the first time the file was seen like this, for the settle and stall times
+            self.seen[name] = previous[:3] + [count] if unchanged else current + [now, 1]
+            return (False, hold)
+        return (True, reason)
+
+    def finish(self):
+        """
+        End of a complete scan: forget files released or gone, keep the ones to observe again.
+
+        :return: None
+        """
+        if self.seen != self.load():
+            self.observed = self.seen
+            self.dirty = True
+        self.seen = {}
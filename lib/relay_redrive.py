@@ -0,0 +1,196 @@
+"""
+Automatic re-drive of quarantined files.
+
+Each forward directory keeps a sidecar index next to its quarantined files,
+recording why and when every file was quarantined, whether the cause looks
+transient (timeouts, overloaded or unreachable host) or permanent (permission
+denied, bad data), how many attempts were made and which destinations still
+miss the file. Transient failures come due again after an exponential backoff,
+up to a maximum number of attempts, and are then sent to the missing
+destinations only.
+"""
+
+import errno
+import ftplib
+import json
+import logging
+import os
+import socket
+import time
+from .relay_concurrency import signals_overload
+
+INDEX_NAME = ".redrive.json"
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+MAX_ATTEMPTS = 8
+BASE_DELAY = 60  # seconds before the first re-drive, doubled after each attempt
+MAX_DELAY = 6 * 3600
+
+_PERMANENT_TYPES = ("AuthenticationException",)  # paramiko, checked before its base SSHException
+_TRANSIENT_TYPES = ("SSHException", "NoValidConnectionsError")
+_TRANSIENT_ERRNOS = (errno.ECONNRESET, errno.ECONNREFUSED, errno.ECONNABORTED, errno.ETIMEDOUT, errno.EPIPE,
+                     errno.EHOSTUNREACH, errno.ENETUNREACH, errno.ENETDOWN, errno.EAGAIN)
+
+
+def classify(error):
+    """
+    Tell if the failure of an upload is worth retrying. The chain of causes is walked
+    and the first exception recognised decides; messages are never looked at.
+
+    :param error: exception of the failed upload, or None if unknown
+    :return: TRANSIENT or PERMANENT
+    """
+    ex = error
+    seen = 0
+    while ex is not None and seen < 10:
+        names = [cls.__name__ for cls in type(ex).__mro__]  # paramiko, without importing it
+        if signals_overload(ex) or isinstance(ex, (EOFError, ConnectionError, socket.timeout, socket.gaierror)):
+            return TRANSIENT
+        if isinstance(ex, ftplib.error_perm) or isinstance(ex, (FileNotFoundError, PermissionError)):
+            return PERMANENT
+        if any(name in _PERMANENT_TYPES for name in names):
+            return PERMANENT
+        if isinstance(ex, OSError) and ex.errno in _TRANSIENT_ERRNOS:
+            return TRANSIENT
+        if any(name in _TRANSIENT_TYPES for name in names):
+            return TRANSIENT
+        ex = ex.__cause__ or ex.__context__
+        seen += 1
+    return TRANSIENT  # unknown: retried, but only up to the maximum attempts
+
+
+class RelayRedriveIndex(object):
+    """
+    Sidecar index of the quarantine folder of one forward directory.
+    """
+
+    def __init__(self, quarantine_dir, max_attempts=MAX_ATTEMPTS, base_delay=BASE_DELAY):
+        """
+        Class initializer.
+
+        :param quarantine_dir: quarantine folder of the forward directory
+        :param max_attempts: attempts, the first upload included, before a file is left for manual handling
+        :param base_delay: seconds before the first re-drive
+        """
+        self.log = logging.getLogger(__name__)
+        self.quarantine_dir = quarantine_dir
+        self.index_file = os.path.join(quarantine_dir, INDEX_NAME)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.records = None  # name in quarantine_dir -> record, loaded on first use
+        self.dirty = False
+        return
+
+    def load(self):
+        if self.records is None:
+            try:
+                with open(self.index_file, 'r') as f:
+                    self.records = json.load(f)
+            except FileNotFoundError:
+                self.records = {}
+            except (OSError, ValueError) as ex:
+                self.log.exception(ex)
+                self.log.error("Unable to read re-drive index {0}, starting a new one".format(self.index_file))
+                self.records = {}
+        return self.records
+
+    def save(self):
+        """
+        Write the index if it changed, atomically.
+
+        :return: None
+        """
+        if not self.dirty:
+            return
+        if not os.path.isdir(self.quarantine_dir):
+            return  # nothing was quarantined
+        tmp = "{0}.{1}.tmp".format(self.index_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.records, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.index_file)
+        self.dirty = False
+
+    def next_delay(self, attempts):
+        return min(MAX_DELAY, self.base_delay * (2 ** max(0, attempts - 1)))
+
+    def add(self, name, source, reason, cause, missing):
+        """
+        Record a file just moved to the quarantine.
+
+        :param name: file name inside the quarantine folder
+        :param source: path the file was quarantined from
+        :param reason: text of the failure
+        :param cause: TRANSIENT or PERMANENT, see classify()
+        :param missing: sections the file was not sent to
+        :return: None
+        """
+        records = self.load()
+        now = time.time()
+        records[name] = {"source": source, "reason": reason, "cause": cause,
+                         "quarantined_at": now, "attempts": 1, "missing": list(missing),
+                         "next_attempt": now + self.next_delay(1) if cause == TRANSIENT else None}
+        self.dirty = True
+        self.log.info("Quarantined {0} ({1}: {2}), missing for {3}".format(name, cause, records[name]["reason"], missing))
+
+    def due(self, sections, now=None):
+        """
+        Return the quarantined files to re-drive now, pruning records of files gone meanwhile.
+
+        :param sections: sections currently configured, other destinations are ignored
+        :param now: time to compare with, defaults to time.time()
+        :return: list of (path, missing sections)
+        """
+        records = self.load()
+        now = time.time() if now is None else now
+        result = []
+        for name in list(records):
+            rec = records[name]
+            path = os.path.join(self.quarantine_dir, name)
+            if not os.path.isfile(path):
+                del records[name]  # handled by hand
+                self.dirty = True
+                continue
+            if rec["cause"] != TRANSIENT or rec["next_attempt"] is None or rec["next_attempt"] > now:
+                continue
+            missing = [sect for sect in rec["missing"] if sect in sections]
+            if not missing:
+                rec["cause"] = PERMANENT
+                rec["reason"] = "destinations {0} no longer configured".format(rec["missing"])
+                self.dirty = True
+                continue
+            result.append((path, missing))
+        return result
+
+    def retried(self, path, sent, error):
+        """
+        Account for a re-drive which did not reach every missing destination.
+
+        :param path: quarantined file
+        :param sent: sections it was sent to this time
+        :param error: exception of the failed upload
+        :return: None
+        """
+        rec = self.load().get(os.path.basename(path))
+        if rec is None:
+            return
+        rec["missing"] = [sect for sect in rec["missing"] if sect not in sent]
+        rec["attempts"] += 1
+        rec["reason"] = str(error) if error else "unknown"
+        rec["cause"] = classify(error)
+        if rec["cause"] == TRANSIENT and rec["attempts"] < self.max_attempts:
+            rec["next_attempt"] = time.time() + self.next_delay(rec["attempts"])
+        else:
+            rec["next_attempt"] = None
+            self.log.error("Giving up re-driving {0} after {1} attempt(s): {2}".format(
+                path, rec["attempts"], rec["reason"]))
+        self.dirty = True
+
+    def resolve(self, path):
+        """
+        Forget a file which reached every missing destination.
+
+        :param path: quarantined file
+        :return: None
+        """
+        if self.load().pop(os.path.basename(path), None) is not None:
+            self.dirty = True
@@ -0,0 +1,131 @@
+"""
+Registry of transports, the classes uploading files for one section of .config.ini.
+
+A transport is a class built as Cls(host, login, passwd, dir, **options) with
+ftp_open(), ftp_upload(file) and ftp_close(), like RelayFtp and RelaySftp.
+It is looked up by the 'mode' of the section, from:
+  - the built-in table below,
+  - entry points of the group 'tdsrelay.transports' of installed packages,
+  - register_transport() at runtime,
+  - or a 'package.module:Class' spec written as mode in the .config.ini.
+Classes are imported on first use only and cached. The options a transport
+accepts are the keyword parameters of its constructor; other keys of the
+section are ignored.
+"""
+
+import importlib
+import inspect
+import logging
+from .relay_transmission_error import RelayTransmissionError
+
+try:
+    from importlib.metadata import entry_points
+except ImportError:  # Python < 3.8
+    entry_points = None
+
+ENTRY_POINT_GROUP = "tdsrelay.transports"
+
+# mode -> "module:Class" spec, or the class itself once imported
+_registry = {
+    "FTP": "lib.relayftp:RelayFtp",
+    "SFTP": "lib.relaysftp:RelaySftp",
+    "LOCAL": "lib.relaylocal:RelayLocal",
+    "MEMORY": "lib.relaymemory:RelayMemory",
+}
+_entry_points_loaded = False
+_accepted = {}  # transport class -> option names, None for any
+_ignored = set()  # (class, option) already warned about
+
+log = logging.getLogger(__name__)
+
+
+def register_transport(mode, transport):
+    """
+    Register a transport for a mode, replacing any previous one.
+
+    :param mode: mode name as written in .config.ini, case insensitive
+    :param transport: class, or "module:Class" spec imported on first use
+    :return: None
+    """
+    _registry[mode.upper()] = transport
+
+
+def _load_entry_points():
+    global _entry_points_loaded
+    if _entry_points_loaded or entry_points is None:
+        return
+    _entry_points_loaded = True
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        eps = eps.select(group=ENTRY_POINT_GROUP)
+    else:  # Python 3.8 / 3.9 return a dict of groups
+        eps = eps.get(ENTRY_POINT_GROUP, [])
+    for ep in eps:
+        _registry.setdefault(ep.name.upper(), ep.value)
+
+
+def _import(spec):
+    module, sep, name = spec.partition(":")
+    if not sep:
+        raise RelayTransmissionError("Transport spec '{0}' is not of the form module:Class".format(spec))
+    return getattr(importlib.import_module(module), name)
+
+
+def get_transport_class(mode):
+    """
+    Return the transport class of a mode.
+
+    :param mode: mode of the section, a registered name or a "module:Class" spec
+    :return: transport class
+    """
+    key = mode.strip().upper()
+    if key not in _registry:
+        _load_entry_points()
+    if key not in _registry:
+        if ":" in mode:
+            _registry[key] = mode.strip()
+        else:
+            raise RelayTransmissionError("Unknown transport mode '{0}', expected one of {1}".format(
+                mode, sorted(_registry)))
+    transport = _registry[key]
+    if isinstance(transport, str):
+        # Note: ImportError, e.g. of pysftp, propagates for the caller to give a tip
+        transport = _import(transport)
+        _registry[key] = transport
+        log.debug("Loaded transport {0} for mode {1}".format(transport.__name__, key))
+    return transport
+
+
+def create_transport(mode, host, login, passwd, dir, **options):
+    """
+    Build the transport of a mode for one destination.
+
+    :param options: optional keys of the section, those the transport accepts are passed on
+    :return: transport instance, not opened yet
+    """
+    transport = get_transport_class(mode)
+    return transport(host, login, passwd, dir, **accepted_options(transport, options))
+
+
+def accepted_options(transport, options):
+    """
+    Keep the options a transport class takes, warning once about each other one.
+
+    :param transport: transport class
+    :param options: dict of option name to value
+    :return: dict of the accepted options
+    """
+    if transport not in _accepted:
+        params = list(inspect.signature(transport).parameters.values())[4:]  # after host, login, passwd, dir
+        if any(p.kind == p.VAR_KEYWORD for p in params):
+            _accepted[transport] = None
+        else:
+            _accepted[transport] = set(p.name for p in params if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY))
+    names = _accepted[transport]
+    if names is None:
+        return dict(options)
+    for key in options:
+        if key not in names and (transport, key) not in _ignored:
+            _ignored.add((transport, key))
+            log.warning("Ignoring option '{0}', not taken by transport {1}".format(key, transport.__name__))
+    return dict((key, value) for key, value in options.items() if key in names)
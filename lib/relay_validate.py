@@ -0,0 +1,86 @@
+"""
+Validation of .dat envelopes, runnable in worker processes.
+
+Inflating the zip and parsing request.xml is CPU bound, so the relay spreads it
+over a process pool in chunks of files. The customers of each section are
+handed to every worker once, by init_worker(), instead of with each chunk.
+Each file is checked on its own: a corrupt zip only fails that file.
+Workers are never forked from the relay, which runs upload, transport, log and
+lease threads by then: a child could inherit a lock held by one of them.
+"""
+
+import multiprocessing
+import zipfile
+import xml.etree.ElementTree as ET
+
+_customers_by_section = None  # list of (section, customers), set once per worker process
+
+
+def pool_context():
+    """
+    Multiprocessing context of the validation pool: forkserver where available, otherwise spawn.
+
+    :return: multiprocessing context
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def init_worker(customers_by_section):
+    """
+    Process pool initializer, keeps the parsed config in the worker.
+
+    :param customers_by_section: list of (section, list of customers)
+    :return: None
+    """
+    global _customers_by_section
+    _customers_by_section = customers_by_section
+
+
+def read_customer(file):
+    """
+    Find the text of node <CustomerName> of request.xml inside a .dat file.
+
+    :param file: file being processed
+    :return: text of <CustomerName/>, or None if there is no such node
+    """
+    with zipfile.ZipFile(file, "r") as z:
+        with z.open("request.xml") as x:
+            tree = ET.parse(x)
+    node = tree.find(".//CustomerName")
+    return None if node is None else node.text
+
+
+def check_envelope(file, customers_by_section):
+    """
+    Check the customer of a .dat file against every section.
+
+    :param file: file being processed
+    :param customers_by_section: list of (section, list of customers)
+    :return: tuple of (file, customer or None, error message or None)
+    """
+    try:
+        customer = read_customer(file)
+    except Exception as ex:
+        return (file, None, "Cannot read envelope of {0}: {1}: {2}".format(file, type(ex).__name__, ex))
+    if customer is None:
+        return (file, None, "Cannot get customer info. from {0}".format(file))
+    customer = str(customer)
+    for (sect, customers) in customers_by_section:
+        if customer not in customers:
+            return (file, customer, "Found inconsistency of customers info. in the .dat file, expect {0}, actual {1}".format(
+                customers, customer))
+    return (file, customer, None)
+
+
+def check_envelopes(files, customers_by_section=None):
+    """
+    Check a chunk of files, in order.
+
+    :param files: list of files
+    :param customers_by_section: defaults to the one given to init_worker()
+    :return: list of check_envelope() results
+    """
+    if customers_by_section is None:
+        customers_by_section = _customers_by_section
+    return [check_envelope(file, customers_by_section) for file in files]
@@ -3,6 +3,7 @@ import os
 import logging
 from subprocess import call
 from .relay_transmission_error import *
+from .relay_logging import file_event
 
 
 class RelayFtp(object):
@@ -20,6 +21,7 @@ class RelayFtp(object):
         self.ftp_login = login
         self.ftp_passwd = passwd
         self.ftp_dir = dir
+        self.last_error = None  # exception of the last failed upload, for the caller to classify
 
         return
 
@@ -51,51 +53,35 @@ class RelayFtp(object):
         :return: True if success, otherwise False
         """
         result = False
-        new_name = None
         try:
             bfn = os.path.basename(file)  # base file name stripped of leading path
-            tmp = bfn + ".tmp"
-            localpath = os.path.dirname(file)
-            realfile = file
-            
+
             # NOTE: it may cause performance if server has much files or bandwidth is not good
-            # remove potential corrupted previous upload
-            files_on_server = self.ftp_conn.nlst()
-            if tmp in files_on_server :
-                self.ftp_conn.delete(tmp)
-                self.log.warn("Found existing .tmp {0}, removed it.".format(tmp))
-            
+            files_on_server = set(self.ftp_conn.nlst())
 
-            # rename original file by incremental number, e.g. a.dat, a-1.dat, a-2.dat
+            # upload under an unused remote name, e.g. a.dat, a-1.dat, a-2.dat; the local file keeps its name
             true_file = bfn
-            
-            while true_file in files_on_server: # to get real unused name
+            while true_file in files_on_server:  # to get real unused name
                 true_file = incremental_file_name(true_file)
-                files_on_server = self.ftp_conn.nlst()
-        
             if true_file != bfn:  # updated
-                self.log.info("Temporarily renaming {0} to {1}".format(bfn, true_file) )
-                new_name = os.path.join(localpath, true_file)
-                os.rename(file, new_name)    
-            
-            if new_name:
-                bfn = true_file
-                tmp =  bfn + ".tmp"
-                realfile = os.path.join( os.path.dirname(file) , bfn)
-            
+                file_event(self.log, "rename", file, to=true_file)
+            tmp = true_file + ".tmp"
+
+            # remove potential corrupted previous upload
+            if tmp in files_on_server:
+                self.ftp_conn.delete(tmp)
+                self.log.warn("Found existing .tmp {0}, removed it.".format(tmp))
+
             cmd = "STOR {0}".format(tmp)
-            self.ftp_conn.storbinary(cmd, open(realfile, mode='rb'), 8192)  # upload named with tmp extension
-            self.ftp_conn.rename(tmp, bfn)  # rename to canonical file name
+            with open(file, mode='rb') as f:
+                self.ftp_conn.storbinary(cmd, f, 8192)  # upload named with tmp extension
+            self.ftp_conn.rename(tmp, true_file)  # rename to canonical file name
             result = True
         except Exception as ex:
             self.log.exception(ex)
+            self.last_error = ex
             raise RelayTransmissionError("Exception uploading file {0}".format(file)) from ex
         finally:
-            # always to rename back for other to upload
-            if new_name:
-                self.log.info("Renaming back from {0} to {1}".format(new_name, file) )
-                os.rename(new_name, file) 
-            
             return result
         return False
 
@@ -0,0 +1,95 @@
+"""
+Transport to a directory on disk, e.g. a share mounted from the YMS host, with the same API as RelayFtp.
+The file is copied to a .tmp name of its own and published with a no-clobber link, so concurrent
+uploads of files with the same name each get their own -N name.
+"""
+
+import logging
+import os
+import shutil
+import threading
+from .relay_transmission_error import *
+from .relay_logging import file_event
+
+
+class RelayLocal(object):
+    def __init__(self, host, login, passwd, dir):
+        """
+        Class initializer.
+
+        :param host: ignored, kept for the common transport API
+        :param login: ignored
+        :param passwd: ignored
+        :param dir: destination directory
+        """
+        self.log = logging.getLogger(__name__)
+        self.ftp_host = host
+        self.ftp_dir = dir
+        return
+
+    def ftp_open(self):
+        """
+        Checks the destination directory.
+
+        :return: None
+        """
+        if not os.path.isdir(self.ftp_dir):
+            raise RelayTransmissionError("Destination directory {0} does not exist".format(self.ftp_dir))
+        self.log.info("Using destination directory {0}".format(self.ftp_dir))
+        return
+
+    def ftp_upload(self, file):
+        """
+        Copies file to the destination directory.
+
+        :param file: file being processed
+        :return: True if success, otherwise False
+        """
+        result = False
+        bfn = os.path.basename(file)
+        tmp = os.path.join(self.ftp_dir, "{0}.{1}.{2}.tmp".format(bfn, os.getpid(), threading.get_ident()))
+        try:
+            shutil.copyfile(file, tmp)
+            true_file = self._publish(tmp, bfn)
+            if true_file != bfn:
+                file_event(self.log, "rename", file, to=true_file)
+            result = True
+        except Exception as ex:
+            self.log.exception(ex)
+            raise RelayTransmissionError("Exception copying file {0}".format(file)) from ex
+        finally:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+        return result
+
+    def _publish(self, tmp, bfn):
+        """
+        Give the copy its canonical name, by incremental number if taken, e.g. a.dat, a-1.dat, a-2.dat.
+
+        :return: name given
+        """
+        true_file = bfn
+        while True:
+            dest = os.path.join(self.ftp_dir, true_file)
+            try:
+                os.link(tmp, dest)  # fails instead of replacing an existing file
+                return true_file
+            except FileExistsError:
+                true_file = incremental_file_name(true_file)
+            except OSError:
+                # no hard links here, e.g. a share: look for a clash, then rename
+                if os.path.exists(dest):
+                    true_file = incremental_file_name(true_file)
+                    continue
+                os.replace(tmp, dest)
+                return true_file
+
+    def ftp_close(self):
+        """
+        Nothing to close.
+
+        :return: None
+        """
+        return
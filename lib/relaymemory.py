@@ -0,0 +1,92 @@
+"""
+In-memory transport with injectable latency and failure rates, with the same API as RelayFtp.
+
+Nothing leaves the process, so a relay run against it measures the engine's own
+overhead (scan, validate, bookkeeping) apart from the network. Example section:
+
+    [Bench]
+    customer = OSAT1
+    host = bench
+    mode = MEMORY
+    user =
+    passwd =
+    outdir =
+    latency = 0.005
+    failure_rate = 0.01
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from .relay_transmission_error import *
+
+# host -> {file name: size}, uploads of every instance, for inspection after a run
+STORE = {}
+_store_lock = threading.Lock()
+
+
+class RelayMemory(object):
+    def __init__(self, host, login, passwd, dir, latency=0.0, failure_rate=0.0, open_failure_rate=0.0,
+                 read=0, seed=None):
+        """
+        Class initializer.
+
+        :param host: key of the uploads in STORE
+        :param latency: seconds each upload takes
+        :param failure_rate: probability, 0 to 1, of an upload to fail
+        :param open_failure_rate: probability of ftp_open to fail
+        :param read: read the file content on upload, to account for local I/O
+        :param seed: seed of the failure draws, for repeatable runs
+        """
+        self.log = logging.getLogger(__name__)
+        self.ftp_host = host
+        self.ftp_dir = dir
+        self.latency = float(latency)
+        self.failure_rate = float(failure_rate)
+        self.open_failure_rate = float(open_failure_rate)
+        self.read = bool(read)
+        self.random = random.Random(seed)
+        self.store = None
+        return
+
+    def ftp_open(self):
+        """
+        Opens the in-memory destination.
+
+        :return: None
+        """
+        if self.random.random() < self.open_failure_rate:
+            raise RelayTransmissionError("Injected failure opening connection to host {0}".format(self.ftp_host))
+        with _store_lock:
+            self.store = STORE.setdefault(self.ftp_host, {})
+        return
+
+    def ftp_upload(self, file):
+        """
+        Records file as uploaded, after the configured latency.
+
+        :param file: file being processed
+        :return: True if success
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        if self.random.random() < self.failure_rate:
+            raise RelayTransmissionError("Injected failure uploading file {0}".format(file))
+        if self.read:
+            with open(file, 'rb') as f:
+                size = len(f.read())
+        else:
+            size = os.path.getsize(file)
+        with _store_lock:
+            self.store[os.path.basename(file)] = size
+        return True
+
+    def ftp_close(self):
+        """
+        Nothing to close.
+
+        :return: None
+        """
+        return
@@ -7,20 +7,35 @@ __author__ = "Alien Zhu <jiacheng.zhu@pdf.com>"
 """
 
 import logging
+import math
 import os
+import threading
+import paramiko
 import pysftp
 from .relay_transmission_error import *
+from .relay_logging import file_event
+
+
+# Defaults of the high-throughput upload path, can be overridden per section of .config.ini
+CHUNK_SIZE = 32768  # bytes per write request, paramiko caps a single request at 32k anyway
+WINDOW = 64  # write requests in flight per channel
+LARGE_FILE_SIZE = 8 * 1024 * 1024  # files from this size use the pipelined path
+CHANNELS = 1  # channels writing ranges of one file in parallel
+PARALLEL_SIZE = 256 * 1024 * 1024  # files from this size are split over 'channels'
 
 
 class RelaySftp:
 
-    def __init__(self, host, login, passwd, dir):
+    def __init__(self, host, login, passwd, dir, chunk_size=CHUNK_SIZE, window=WINDOW,
+                 large_file_size=LARGE_FILE_SIZE, channels=CHANNELS, parallel_size=PARALLEL_SIZE):
         """
         Class initializer.
 
-        :param dryrun: boolean to enable non-destructive log only mode
-        :param fdir: path to file forward directory
-        :param qdir: path to file quarantine directory
+        :param chunk_size: bytes per write request of the pipelined path
+        :param window: write requests kept in flight per channel
+        :param large_file_size: file size from which the pipelined path is used, 0 to disable it
+        :param channels: number of channels writing ranges of one file at offsets
+        :param parallel_size: file size from which a file is split over several channels
         """
         self.log = logging.getLogger(__name__)
         self.ftp_conn = None  # handle for open FTP connection to YMS host
@@ -29,6 +44,12 @@ class RelaySftp:
         self.ftp_login = login
         self.ftp_passwd = passwd
         self.ftp_dir = dir
+        self.last_error = None  # exception of the last failed upload, for the caller to classify
+        self.chunk_size = int(chunk_size)
+        self.window = max(1, int(window))
+        self.large_file_size = int(large_file_size)
+        self.channels = max(1, int(channels))
+        self.parallel_size = int(parallel_size)
         return
 
     def ftp_open(self):
@@ -65,52 +86,117 @@ class RelaySftp:
         :param file: file being processed
         :return: True for success, otherwise False   """
         result = False
-        new_name = None
         try:
             bfn = os.path.basename(file)  # base file name stripped of leading path
-            tmp = bfn + ".tmp"
-            
-            new_name = None
-            # REF: see doc, https://goo.gl/kC9Xjo
-            localpath = os.path.dirname(file)
-            
+
+            # upload under an unused remote name, e.g. a.dat, a-1.dat, a-2.dat; the local file keeps its name
+            true_file = bfn
+            while self.ftp_conn.exists(true_file): # to get real unused name
+                true_file = incremental_file_name(true_file)
+            if true_file != bfn:  # updated
+                file_event(self.log, "rename", file, to=true_file)
+            tmp = true_file + ".tmp"
+
             # remove potential corrupted previous upload
             if self.ftp_conn.exists(tmp):
                 self.ftp_conn.unlink(tmp)
                 self.log.warn("Found existing .tmp {0}, removed it.".format(tmp))
-            
-            # rename original file by incremental number, e.g. a.dat, a-1.dat, a-2.dat
-            true_file = bfn
-            while self.ftp_conn.exists(true_file): # to get real unused name
-                true_file = incremental_file_name(true_file)    
-        
-            if true_file != bfn:  # updated
-                self.log.info("Temporarily renaming {0} to {1}".format(bfn, true_file) )
-                new_name = os.path.join(localpath, true_file)
-                os.rename(file, new_name)    
-            
-            if new_name:
-                bfn = true_file
-                tmp =  bfn + ".tmp"
-                            
-            #self.ftp_conn._sftp.get_channel().settimeout(60) #time is in seconds, Credit:     https://goo.gl/9RNF7v
-            self.ftp_conn.put(os.path.join(localpath, bfn), tmp)
-            self.ftp_conn.rename(tmp, bfn)  # rename to canonical file name
+
+            size = os.path.getsize(file)
+            if self.large_file_size and size >= self.large_file_size:
+                self.put_pipelined(file, tmp, size)
+            else:
+                self.ftp_conn.put(file, tmp)
+            self.ftp_conn.rename(tmp, true_file)  # rename to canonical file name
 
             result = True
             # Notes: remove_file actioin occurs in the caller to make code module-like and less coupling
         except Exception as ex: 
             self.log.exception(ex)
+            self.last_error = ex
             raise RelayTransmissionError("Exception uploading file {0}".format(file)) from ex
         finally:
-            # always to rename back for other to upload
-            if new_name:
-                self.log.info("Renaming back from {0} to {1}".format(new_name, file) )
-                os.rename(new_name, file) 
-                
             return result
         return False
 
+    def put_pipelined(self, localfile, remotefile, size):
+        """
+        Upload a large file keeping up to 'window' write requests in flight on a
+        channel of its own, instead of waiting for each ack. Files from
+        'parallel_size' on are split into ranges written at their offsets over
+        'channels' channels. The size is checked before the caller renames the .tmp.
+
+        :param localfile: local path of the file
+        :param remotefile: remote name to write to
+        :param size: size of localfile in bytes
+        :return: None
+        """
+        transport = self.ftp_conn._transport
+        nparts = self.channels if size >= self.parallel_size else 1
+        part = int(math.ceil(size / float(nparts) / self.chunk_size)) * self.chunk_size or self.chunk_size
+        ranges = [(off, min(part, size - off)) for off in range(0, size, part)] or [(0, 0)]
+
+        self.ftp_conn.open(remotefile, 'wb').close()  # create / truncate, parts are written with r+
+        # the extra channels do not share the chdir of ftp_conn
+        remotefile = self.ftp_conn.normalize(remotefile)
+        if len(ranges) == 1:
+            self._write_range(transport, localfile, remotefile, 0, size)
+        else:
+            errors = []
+            threads = [threading.Thread(target=self._write_range_safe,
+                                        args=(transport, localfile, remotefile, off, length, errors))
+                       for (off, length) in ranges]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            if errors:
+                raise errors[0]
+
+        remote_size = self.ftp_conn.stat(remotefile).st_size
+        if remote_size != size:
+            raise RelayTransmissionError("Size mismatch uploading {0}: local {1}, remote {2}".format(
+                localfile, size, remote_size))
+        self.log.debug("Uploaded {0} bytes of {1} in {2} range(s)".format(size, localfile, len(ranges)))
+
+    def _write_range_safe(self, transport, localfile, remotefile, offset, length, errors):
+        try:
+            self._write_range(transport, localfile, remotefile, offset, length)
+        except Exception as ex:
+            errors.append(ex)
+
+    def _write_range(self, transport, localfile, remotefile, offset, length):
+        """
+        Write 'length' bytes from 'offset' of localfile at the same offset of remotefile.
+
+        Note: relies on paramiko internals (SFTPFile._reqs, SFTPClient._read_response) and on
+        pysftp's Connection._transport, see the versions pinned in requirements.txt.
+        """
+        # SSH channel window large enough for the requests in flight
+        sftp = paramiko.SFTPClient.from_transport(transport, window_size=max(self.chunk_size * self.window, 2 ** 21))
+        try:
+            sftp.get_channel().settimeout(60)
+            with open(localfile, 'rb') as lf, sftp.open(remotefile, 'r+b', bufsize=self.chunk_size) as rf:
+                rf.set_pipelined(True)
+                lf.seek(offset)
+                rf.seek(offset)
+                remaining = length
+                while remaining > 0:
+                    data = lf.read(min(self.chunk_size, remaining))
+                    if not data:
+                        break
+                    rf.write(data)
+                    remaining -= len(data)
+                    # paramiko would otherwise queue as many requests as it can send, collect acks past the window
+                    while len(rf._reqs) > self.window:
+                        sftp._read_response(rf._reqs.popleft())
+                # close() reads but ignores the status of pipelined writes, so collect them here:
+                # a failed write raises instead of leaving a hole in the file
+                while rf._reqs:
+                    sftp._read_response(rf._reqs.popleft())
+        finally:
+            sftp.close()
+
     def ftp_close(self):
         """
         Closes connection to FTP host.
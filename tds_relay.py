@@ -21,27 +21,34 @@ __revision__ = "12fbcce"
 
 import argparse
 from datetime import datetime
-import glob
 import logging
 import os
 import sys
-import shutil
+import threading
 import time
 import configparser
-import zipfile
-import xml.etree.ElementTree as ET
+import concurrent.futures
 from lib.relay_transmission_error import RelayTransmissionError
-import importlib
+from lib.relay_post_action import RelayPostActions, QUARANTINE
+from lib.relay_logging import setup_logging, stop_logging, file_event
+from lib.relay_lease import RelayLease, DEFAULT_TTL
+from lib.relay_pipeline import RelayPipeline, RelayStage
+from lib.relay_audit import RelayAudit, MISSING_NAME
+from lib.relay_transport import create_transport
+from lib.relay_concurrency import RelayConcurrency, is_overload, is_clean_reply, load_limits, save_limits
+from lib.relay_redrive import RelayRedriveIndex, MAX_ATTEMPTS, BASE_DELAY
+from lib.relay_validate import init_worker, check_envelopes, pool_context
+from lib.relay_readiness import RelayReadiness
 
 
 # Define global macro variables
 PRG_NAM = "tdsrelay"
 LOG_NAM = PRG_NAM
 LOG_DIR = '/tmp/tdsrelay_log/'
-LOG_FMT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+SECTION_KEYS = ["customer", "host", "mode", "user", "passwd", "outdir"]  # other keys are transport options
 LOCK_FILE = os.path.join(os.path.dirname(__file__), "{0}.lock".format(PRG_NAM))
-BACKUP_FOLDER_NAME = 'transferred'
-QUARANTINE = "quarantined"
+CONCURRENCY_FILE = os.path.join(os.path.dirname(__file__), "{0}.concurrency.json".format(PRG_NAM))
 
 class TdsRelayUnmetSpecError(Exception):
     """
@@ -63,27 +70,68 @@ class TdsRelay(object):
     Class to conduct file forwarding from TDS to YMS.
     """
 
-    def __init__(self, rdir, search_root=False, no_validate_customer=False, backup_when_succeed=True, all_pass=True, transfer_delay=120):
+    def __init__(self, rdir, search_root=False, no_validate_customer=False, backup_when_succeed=True, all_pass=True, transfer_delay=120,
+                 use_lease=True, lease_ttl=DEFAULT_TTL, validate_workers=2, upload_workers=1, queue_depth=64,
+                 min_connections=1, max_connections=None, redrive_max_attempts=MAX_ATTEMPTS, redrive_base_delay=BASE_DELAY,
+                 validate_processes=None, validate_chunk=32, readiness=True, tmp_rename=False):
         """
         Class initializer.
 
         :param rdir: path to root directory which may contains multiple 'file forward directory'
+        :param use_lease: take a lease on each forward directory, so other relay instances skip it
+        :param lease_ttl: seconds a lease of a crashed instance stays valid
+        :param validate_workers: number of chunks of .dat files validated at once
+        :param upload_workers: number of threads uploading, the ceiling of parallel uploads
+        :param queue_depth: depth of the queue in front of each pipeline stage
+        :param min_connections: lowest number of parallel uploads per host
+        :param max_connections: highest number of parallel uploads per host, at most and by default upload_workers
+        :param redrive_max_attempts: attempts of a file quarantined for a transient cause, 0 disables the re-drive
+        :param redrive_base_delay: seconds before the first re-drive of a quarantined file, doubled after each attempt
+        :param validate_processes: size of the process pool validating .dat files, defaults to the number of CPUs, 0 or 1 validates in threads
+        :param validate_chunk: number of files sent at once to a validating process
+        :param readiness: release files as soon as they are provably complete, transfer_delay becoming the longest wait
+        :param tmp_rename: writers produce files as .tmp and rename them when done, so any other file is complete
         """
         self.log = logging.getLogger(__name__)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.INFO)
-        self.log.addHandler(ch)
         self.root_dir = rdir
         self.config_file = ""
         self.forward_dir = ""
-        self.dat_file_list = list()
         self.search_root = search_root
         self.no_validate_customer = no_validate_customer
         self.backup_when_succeed = backup_when_succeed
         self.all_pass = all_pass
         self.transfer_delay = transfer_delay
-
-        self.ftp_conn = None  # handle for open FTP connection to YMS host
+        self.use_lease = use_lease
+        self.lease_ttl = lease_ttl
+        self.lease = None  # lease on current forward_dir
+        self.validate_workers = validate_workers
+        self.upload_workers = upload_workers
+        self.queue_depth = queue_depth
+        self.sections = []
+        self.section_configs = {}
+        self.min_connections = min_connections
+        self.max_connections = min(max_connections or upload_workers, upload_workers)
+        if max_connections and max_connections > upload_workers:
+            # more slots than upload threads can never all be used
+            self.log.warning("max_connections {0} above upload_workers {1}, using {1}".format(
+                max_connections, upload_workers))
+        self.controllers = {}  # host -> RelayConcurrency, kept for the whole run
+        self.learned_limits = {}
+        self._pools = {}  # section -> idle open connections
+        self.redrive_max_attempts = redrive_max_attempts
+        self.redrive_base_delay = redrive_base_delay
+        self.redrive = None  # re-drive index of the quarantine of current forward_dir
+        self.redrive_sections = {}  # quarantined file being re-driven -> sections it still misses
+        self.validate_processes = os.cpu_count() if validate_processes is None else validate_processes
+        self.validate_chunk = max(1, validate_chunk)
+        self.validate_pool = None  # process pool of current forward_dir, started on first use
+        self._validate_lock = threading.Lock()
+        self.readiness = readiness
+        self.tmp_rename = tmp_rename
+        self.readiness_states = {}  # forward_dir -> RelayReadiness, kept while the process lives
+        self._pool_lock = threading.Lock()
+        self.post_actions = None  # deferred backup/remove/quarantine stage of current forward_dir
+        self.audit = None  # transfer accounting of current forward_dir
         return
 
     def run(self):
@@ -95,6 +143,7 @@ class TdsRelay(object):
             self.log.error(fullp + " does not exist")
             return
 
+        self.learned_limits = load_limits(CONCURRENCY_FILE)
         subdirs = []
         if not self.search_root:
             subdirs = [name for name in os.listdir(fullp) if os.path.isdir(os.path.join(fullp, name))]
@@ -108,16 +157,41 @@ class TdsRelay(object):
 
             # NOTE: program run as single thread,
             # so we just change the instance variable for each sub folder
+            self.forward_dir = os.path.join(fullp, x)
             try:
-                self.forward_dir = os.path.join(fullp, x)
+                if self.use_lease:
+                    self.lease = RelayLease(self.forward_dir, self.lease_ttl)
+                    if not self.lease.acquire():
+                        self.log.info("Skipping {0}, leased by another relay instance".format(self.forward_dir))
+                        continue
                 self.prepare_for_subfolder()
                 self.run_on_subfolder()
+            except OSError as ex:
+                # e.g. read-only share or stale NFS handle while leasing/preparing: go on with the other folders
+                self.log.exception(ex)
+                self.log.error("Unable to process folder {0}".format(self.forward_dir))
+                continue
             except Exception as ex:
                 # we leave a timestamped lock here until the .lock is removed
                 # Note: this logging may be too much.  self.log.exception(ex)
                 # here there is much info in diagnostic, detail log should be inside
                 ##  self.log.error("Exception processing under folder {0}".format(self.forward_dir))
                 continue
+            finally:
+                if self.lease:
+                    try:
+                        self.lease.release()  # only removes the lease if it is ours
+                    except OSError as ex:
+                        self.log.exception(ex)
+                        self.log.error("Unable to release lease on {0}".format(self.forward_dir))
+                    self.lease = None
+
+        if self.controllers:
+            try:
+                save_limits(CONCURRENCY_FILE, self.controllers)
+            except Exception as ex:
+                self.log.exception(ex)
+                self.log.error("Unable to save parallel upload limits to {0}".format(CONCURRENCY_FILE))
         return
 
     def prepare_for_subfolder(self):
@@ -126,117 +200,52 @@ class TdsRelay(object):
         """
         self.log.info("changed forward_dir to : " + self.forward_dir)
         self.config_file = os.path.join(self.forward_dir, ".config.ini")
-        self.dat_file_list.clear()
+        self.redrive = RelayRedriveIndex(os.path.join(self.forward_dir, QUARANTINE),
+                                         self.redrive_max_attempts, self.redrive_base_delay)
+        self.redrive_sections = {}
+        self.post_actions = RelayPostActions(self.forward_dir, self.redrive)
+        # finish moves of a previous run interrupted after uploading, before the files are scanned again
+        self.post_actions.recover()
+        if self.readiness and self.forward_dir not in self.readiness_states:
+            self.readiness_states[self.forward_dir] = RelayReadiness(self.forward_dir, self.transfer_delay, self.tmp_rename)
 
     def run_on_subfolder(self):
         """
         Main method to perform data file forwarding form TDS to YMS.
 
+        Files flow through a pipeline of stages connected by bounded queues:
+        scan -> validate -> upload -> post, so validation of the next files
+        overlaps the uploads of the current ones.
+
         :return: None
         """
         t0 = datetime.now()
-        logfile = self.log
-        cnt_fwd = 0
-        # cnt_del = 0
-        sections_cnt = 0
-        quarantine_cnt = 0
-        try_to_send_by_sections = {}
-        did_sent_by_sections = {}
-        quarantine_files = []
-        try:
+        self.audit = RelayAudit([])
 
-            if not os.path.exists(self.config_file):
-                self.log.warning(
-                    "Forward folder doesn't contains a config.ini as expected, under {0}".format(self.forward_dir))
-                return
-            self.get_file_list()
-        except Exception as ex:
-            # self.log.exception("Exception processing sub folder preparing file list :{0}".format(self.forward_dir))
-            # Notes: if try to re-throw exception, please don't do the logging here! The line above
-            raise TdsRelayError("Exception processing subfolder when preparing file list :{0}".format(
-                self.forward_dir)) from ex
-
-        if not self.dat_file_list:
-            self.log.info("no files need transfer")
+        if not os.path.exists(self.config_file):
+            self.log.warning(
+                "Forward folder doesn't contains a config.ini as expected, under {0}".format(self.forward_dir))
             return
 
+        pipeline = None
         try:
-            sections = self.read_config_sections()
-            sections_cnt = len(sections)
-            self.log.info("Found {0} FTP/SFTP connection info. {1}".format(len(sections), sections))
-
-            shouldPostAction = False
-            section_run_count = 0
-            for sect in sections:
-                # TODO:  it may cost to much establish/close FTP connection for each files. Consider using connection pool
-                # read ini file
-                section_run_count = section_run_count +1
-                if section_run_count == len(sections):
-                    shouldPostAction = True
-
-                (mode, login, passwd, host, customers, dir) = self.read_config_ini(sect)
-                self.ftp_conn = self.choose_transmit_mode(mode, logfile, login, passwd, host, dir)
-                self.ftp_conn.ftp_open()  # open connection to YMS host
-                self.log.info("Processing forwarding directory {0}".format(self.forward_dir))
-
-                # Note: Log message that transmission failed for this file and keep going
-                # For at least a few failures, this is not fatal, so we can continue, if many failures, maybe stop.
-
-                # audit use
-                if sect not in try_to_send_by_sections:
-                    try_to_send_by_sections[sect] = []
-                if sect not in did_sent_by_sections:
-                    did_sent_by_sections[sect] = []
-
-                # prepare to send files
-                for file in self.dat_file_list:
-                    try:
-                        self.log.info("Forwarding file {0}".format(file))
-                        try_to_send_by_sections[sect].append(file)
-
-                        result = self.ftp_conn.ftp_upload(file)
-
-                        if result:
-                            cnt_fwd += 1
-                            did_sent_by_sections[sect].append(file)
-
-                            # Post actions
-                            if shouldPostAction:
-                                if self.backup_when_succeed:
-                                    try:
-                                        # create subfolder at current directory if not exist
-                                        bak_dir = os.path.join(self.forward_dir, BACKUP_FOLDER_NAME)
-                                        if not os.path.exists(bak_dir):
-                                            os.makedirs(bak_dir)
-                                        # move
-                                        if os.path.exists(file): # potential moved due to other processing logic ,e.g. quarantine
-                                            shutil.move(file, bak_dir)
-                                            self.log.info("Backup the data file under {0}".format(bak_dir))
-                                    except Exception as ex:
-                                        self.quarantine_file(file, self.forward_dir)
-                                        quarantine_files.append(file)
-                                        quarantine_cnt += 1
-                                        self.log.exception(ex)
-                                        self.log.error("Unable to move file {0} for backup".format(file))
-                                    continue
-                                else:
-                                    if os.path.exists(file):
-                                        self.log.info("Removed data file : {0}".format(file))
-                                        self.remove_file(file)  # Notes only to delete file if uploads OK
-                                        
-                        else:  # ftp_upload throws exception will not be caught here, we have to use result's value
-                            self.quarantine_file(file, self.forward_dir)
-                            quarantine_cnt += 1
-                            quarantine_files.append(file)
-                    except Exception as ex:
-                        self.quarantine_file(file, self.forward_dir)
-                        quarantine_cnt += 1
-                        quarantine_files.append(file)
-                        self.log.exception(ex)
-                        self.log.error("Exception transferring data file  {0}".format(file))
-                        continue
-
-                    # Note: if ftp_upload raises exception, putting 'else' here is unreachable probably
+            self.sections = self.read_config_sections()
+            self.section_configs = dict((sect, self.read_config_ini(sect)) for sect in self.sections)
+            self.log.info("Found {0} FTP/SFTP connection info. {1}".format(len(self.sections), self.sections))
+            self.audit = RelayAudit(self.sections, missing_file=os.path.join(self.forward_dir, MISSING_NAME))
+            if self.redrive_max_attempts:
+                self.redrive_sections = dict(self.redrive.due(self.sections))
+                if self.redrive_sections:
+                    self.log.info("Re-driving {0} quarantined file(s)".format(len(self.redrive_sections)))
+
+            self.log.info("Processing forwarding directory {0}".format(self.forward_dir))
+            pipeline = RelayPipeline([
+                RelayStage("validate", self.check_chunk, max(self.validate_workers, self.validate_processes),
+                           self.queue_depth, batch=self.validate_chunk),
+                RelayStage("upload", self.upload_file, self.upload_workers, self.queue_depth),
+                RelayStage("post", self.post_file, 1, self.queue_depth, finish_on_abort=True),
+            ], name=os.path.basename(os.path.normpath(self.forward_dir)))
+            pipeline.run(self.iter_file_list())
 
         except RelayTransmissionError as ex:
             # here we handling the FTP exceptions caused by any action except the ftp_upload
@@ -251,73 +260,344 @@ class TdsRelay(object):
             self.log.exception(ex)
             raise TdsRelayError from ex
         finally:
-            t1 = datetime.now()
-            td = t1 - t0
-            self.log.info("Processing completed in {0}".format(td))
-            # Note: deleting count is not implemented
-            self.log.info("For folder : {0} ".format(self.forward_dir))
-            self.log.info("Total {0} files sent to quarantine : {1} ".format(quarantine_cnt, quarantine_files))
-            self.log.info("{0} out of {1} (number of files: {2} ) forwarded to YMS {3} host(s)".format(cnt_fwd, sections_cnt * len(self.dat_file_list),  len(self.dat_file_list), sections_cnt))
-            if sections_cnt * len(self.dat_file_list) != cnt_fwd:
-                self.log.error("Missing files in transmission ...")
-                sections = self.read_config_sections()
-                for sect in sections:
-                    diffs= diff_of_lists(try_to_send_by_sections[sect], did_sent_by_sections[sect])
-                    self.log.error("For ftp/sftp connection '{0}' the missing are :  {1}".format(sect, diffs))
-
-            self.log.info("----")
-            # self.log.info("{0} files removed from forward queue".format(cnt_del))
-            if self.ftp_conn:
-                self.ftp_conn.ftp_close()
+            self.close_connections()
+            if self.validate_pool is not None:
+                self.validate_pool.shutdown()
+                self.validate_pool = None
+            self.redrive_sections = {}
+            self.save_readiness()
+            # apply the remaining post actions in bulk, once every upload of this folder is done
+            self.apply_post_actions()
+
+            if pipeline is not None and not self.audit.files:
+                self.log.info("no files need transfer")
+                self.audit.close()
+            else:
+                t1 = datetime.now()
+                td = t1 - t0
+                self.log.info("Processing completed in {0}".format(td))
+                # Note: deleting count is not implemented
+                self.audit.report(self.forward_dir)
+                self.log.info("----")
+                # self.log.info("{0} files removed from forward queue".format(cnt_del))
         return
 
-    def get_file_list(self):
+    def iter_file_list(self):
+        """
+        Scan stage: lazily yield the quarantined files due for a re-drive, then the files
+        of forward_dir which are completely written, or old enough to be sent.
 
-        # Loop through files in forward cache directory
-        forward_list = []
-        if self.all_pass:
-            forward_list = glob.glob(os.path.join(self.forward_dir, "*.*"))
-            forward_list = filter(lambda x: not x.endswith(".tmp"), forward_list)
-        else:
-            forward_list = glob.glob(os.path.join(self.forward_dir, "*.dat"))
-
-        for file in forward_list:
-            bfn = os.path.basename(file)  # base file name without path
-            # only process files that are complete and static
-            if self.get_file_age_seconds(file) < self.transfer_delay:
-                self.log.info("Skipping over potentially changing file {0}".format(bfn))
-                continue  # skip over this file go to next file
-
-            # if original file is just a config file or non .dat file, don't process
-            # This defensive measure is to protect from the glob() file_pattern was changed unexpectedly.
-            if not self.all_pass and not file.endswith(".dat"):
-                continue
+        :return: generator of file paths
+        """
+        for file in list(self.redrive_sections):
+            yield file
+
+        readiness = self.readiness_states.get(self.forward_dir) if self.readiness else None
+        if readiness is not None:
+            readiness.begin()
+        with os.scandir(self.forward_dir) as it:
+            for entry in it:
+                name = entry.name
+                if name.startswith(".") or "." not in name:
+                    continue  # same as glob "*.*"
+                if self.all_pass:
+                    if name.endswith(".tmp"):
+                        continue
+                # if original file is just a config file or non .dat file, don't process
+                elif not name.endswith(".dat"):
+                    continue
+                if not entry.is_file():
+                    continue
+
+                file = entry.path
+                # only process files that are complete and static
+                if readiness is not None:
+                    try:
+                        (ready, reason) = readiness.check(entry)
+                    except FileNotFoundError:
+                        continue  # gone meanwhile
+                    if not ready:
+                        file_event(self.log, "skip_changing", file, reason=reason)
+                        continue
+                    file_event(self.log, "ready", file, reason=reason)
+                elif self.get_file_age_seconds(file) < self.transfer_delay:
+                    file_event(self.log, "skip_changing", file)
+                    continue  # skip over this file go to next file
+                yield file
+        if readiness is not None:
+            readiness.finish()
+
+    def save_readiness(self):
+        """
+        Keep the observations of forward_dir for the next run.
+
+        :return: None
+        """
+        readiness = self.readiness_states.get(self.forward_dir)
+        if readiness is None:
+            return
+        try:
+            readiness.save()
+        except OSError as ex:
+            self.log.exception(ex)
+            self.log.error("Unable to save readiness state {0}".format(readiness.state_file))
+
+    def check_chunk(self, files):
+        """
+        Validate stage: check the customer of a chunk of files against the config,
+        in the process pool when there is one. A file which cannot be read or does not
+        match is logged as TdsRelayUnmetSpecError and skipped, the others go on.
+
+        :param files: list of files
+        :return: list of the files which may be forwarded, in order
+        """
+        if self.no_validate_customer:
+            return files
+        # re-driven files were validated before they were quarantined
+        todo = [file for file in files if file not in self.redrive_sections]
+        results = {}
+        if todo:
+            customers = [(sect, self.section_configs[sect][4]) for sect in self.sections]
+            if self.validate_processes > 1:
+                checked = self.check_in_pool(todo, customers)
+            else:
+                checked = check_envelopes(todo, customers)
+            for (file, customer, error) in checked:
+                results[file] = error
+                # Note: never remove the file here, only remove file if upload succeeds.
+                if error is not None:
+                    self.log.error(TdsRelayUnmetSpecError(error))
+                else:
+                    file_event(self.log, "validate", file, actual=customer)
+        ready = [file for file in files if results.get(file) is None]
+        for file in ready:
+            file_event(self.log, "queue", file)
+        return ready
+
+    def check_in_pool(self, files, customers):
+        """
+        Check a chunk of files in the process pool. If a worker dies, e.g. on a zip bomb,
+        the chunk is checked again one file per task in a new pool, so only the file
+        which kills its worker fails.
+
+        :param files: list of files
+        :param customers: list of (section, list of customers)
+        :return: list of check_envelope() results
+        """
+        pool = self.get_validate_pool(customers)
+        try:
+            return pool.submit(check_envelopes, files).result()
+        except concurrent.futures.process.BrokenProcessPool:
+            self.log.warning("A validating process died on a chunk of {0} file(s), checking them one by one".format(
+                len(files)))
+        pool = self.get_validate_pool(customers, broken=pool)
+        checked = []
+        for file in files:
+            for attempt in range(2):  # the pool may also be broken by another chunk meanwhile
+                try:
+                    checked.extend(pool.submit(check_envelopes, [file]).result())
+                    break
+                except concurrent.futures.process.BrokenProcessPool:
+                    pool = self.get_validate_pool(customers, broken=pool)
+            else:
+                checked.append((file, None, "Validating {0} killed its process".format(file)))
+        return checked
+
+    def get_validate_pool(self, customers, broken=None):
+        """
+        Return the process pool validating .dat files, starting it on first use with the customers of each section.
+
+        :param customers: list of (section, list of customers)
+        :param broken: pool found broken, replaced by a new one unless another thread did it already
+        :return: ProcessPoolExecutor
+        """
+        with self._validate_lock:
+            if broken is not None and self.validate_pool is broken:
+                broken.shutdown(wait=False)
+                self.validate_pool = None
+            if self.validate_pool is None:
+                self.validate_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.validate_processes, mp_context=pool_context(),
+                    initializer=init_worker, initargs=(customers,))
+            return self.validate_pool
+
+    def upload_file(self, file):
+        """
+        Upload stage: send file to every section, over pooled connections.
+
+        Stops at the first section which fails, as the file goes to quarantine anyway.
+        A re-driven file is only sent to the sections it still misses.
+
+        :param file: file being processed
+        :return: tuple of (file, sections tried, sections sent to, exception of the failed section or None)
+        """
+        if self.lease and self.lease.lost:
+            raise TdsRelayError("Lost lease on {0}, leaving the rest to its new owner".format(self.forward_dir))
+        sections = self.redrive_sections.get(file, self.sections)
+        sent = []
+        for sect in sections:
+            error = self.upload_to_section(sect, file)
+            if error is not None:
+                return (file, sections, sent, error)
+            sent.append(sect)
+        return (file, sections, sent, None)
+
+    def upload_to_section(self, sect, file):
+        """
+        Upload file to the host of a section within the parallel uploads its controller allows.
 
+        :param sect: section name of the .config.ini
+        :param file: file being processed
+        :return: None if uploaded, otherwise the exception of the failure
+        """
+        ctl = self.get_controller(sect)
+        while True:
+            token = ctl.acquire()
             try:
-                # we will handle exception thrown by validate_transfer_info()
-                # in case there are multiple data files and others are OK to transfer
-                if not self.no_validate_customer and not self.validate_transfer_info(file):
-                    sections = self.read_config_sections()
-                    for sect in sections:
-                        (FTPmode, login, passwd, host, customers, dir) = self.read_config_ini(sect)
-                        c_dat = self.get_customer_info_from_dat(file)
-                        c_dat = '' if c_dat is None else str(c_dat)
-
-                        # Note: never call remove_file here, only remove file if upload succeeds.
-
-                        err = "Found inconsistency of customers info. in the .dat file, expect {0}, actual {1}".format(customers, c_dat)
-                        raise TdsRelayUnmetSpecError(err)
-            except TdsRelayUnmetSpecError as ex:
-                self.log.exception(ex)
-                continue
+                conn = self.get_connection(sect)
+                break
+            except Exception as ex:
+                # one connection too many while others are still open: back off and wait for a slot
+                retry = is_overload(ex) and ctl.in_flight > 1
+                ctl.release(token, error=ex)
+                if not retry:
+                    raise
+
+        t0 = time.monotonic()
+        result = False
+        error = None
+        # Note: Log message that transmission failed for this file and keep going
+        # For at least a few failures, this is not fatal, so we can continue, if many failures, maybe stop.
+        try:
+            file_event(self.log, "forward", file, section=sect)
+            result = conn.ftp_upload(file)
+        except Exception as ex:
+            self.log.exception(ex)
+            self.log.error("Exception transferring data file  {0}".format(file))
+            error = ex
+        if not result and error is None:  # ftp_upload throws exception will not be caught here, we have to use result's value
+            error = getattr(conn, "last_error", None) or RelayTransmissionError("Upload of {0} failed".format(file))
+        nbytes = 0
+        if result:
+            try:
+                nbytes = os.path.getsize(file)
+            except OSError:
+                pass
+        # after a failure, only a clean refusal of the server leaves the connection worth keeping
+        self.put_connection(sect, conn, keep=result or is_clean_reply(error))
+        ctl.release(token, time.monotonic() - t0, nbytes, error)
+        return None if result else error
+
+    def get_controller(self, sect):
+        """
+        Return the parallel upload controller of the host of a section, shared by all sections of that host.
 
-            # if we get this far in the loop, forwarded the file to YMS system for loading
-            # self.log.info("Forwarding file {0}".format(bfn))
-            # self.ftp_conn.ftp_upload(file)
-            # cnt_fwd += 1
-            self.log.debug("Adding file to file_list" + file)
-            self.dat_file_list.append(file)
+        :param sect: section name of the .config.ini
+        :return: RelayConcurrency instance
+        """
+        host = self.section_configs[sect][3]
+        with self._pool_lock:
+            if host not in self.controllers:
+                self.controllers[host] = RelayConcurrency(host, self.min_connections, self.max_connections,
+                                                          self.learned_limits.get(host))
+            return self.controllers[host]
+
+    def post_file(self, item):
+        """
+        Post stage: book-keeping of one uploaded file and queuing of its post action.
+        Runs in a single worker, so the counters need no lock.
 
+        :param item: tuple returned by upload_file
+        :return: item
+        """
+        (file, sections, sent, error) = item
+        self.audit.record(file, sent, sections)
+
+        redriven = file in self.redrive_sections
+        if redriven:
+            del self.redrive_sections[file]
+            if error is None:
+                self.redrive.resolve(file)
+                self.log.info("Re-drive of {0} succeeded for {1}".format(file, sections))
+        if error is not None:
+            if redriven:
+                self.redrive.retried(file, sent, error)  # stays in the quarantine
+            else:
+                self.quarantine_file(file, self.forward_dir, error, [s for s in sections if s not in sent])
+        # Post actions, deferred and applied in bulk after all uploads
+        elif self.backup_when_succeed:
+            self.post_actions.backup(file)
+        else:
+            self.post_actions.remove(file)  # Notes only to delete file if uploads OK
+        if self.post_actions.is_full():
+            self.apply_post_actions()
+        return item
+
+    def apply_post_actions(self):
+        """
+        Apply the pending post actions in bulk and account for the files quarantined.
+
+        :return: None
+        """
+        try:
+            (backed_up, removed, quarantined) = self.post_actions.apply()
+            self.audit.record_quarantined(quarantined)
+        except Exception as ex:
+            self.log.exception(ex)
+            self.log.error("Unable to apply post actions under {0}, will retry on next run".format(self.forward_dir))
+
+    def get_connection(self, sect):
+        """
+        Take an idle open connection to the host of a section from its pool, or open a new one.
+
+        :param sect: section name of the .config.ini
+        :return: transport instance, see lib.relay_transport
+        """
+        with self._pool_lock:
+            idle = self._pools.setdefault(sect, [])
+            if idle:
+                return idle.pop()
+        (mode, login, passwd, host, customers, dir) = self.section_configs[sect]
+        conn = self.choose_transmit_mode(mode, self.log, login, passwd, host, dir, **self.read_transport_options(sect))
+        conn.ftp_open()  # open connection to YMS host
+        return conn
+
+    def put_connection(self, sect, conn, keep=True):
+        """
+        Give a connection back to the pool of its section, closing the ones the host
+        controller no longer allows to keep.
+
+        :param sect: section name of the .config.ini
+        :param conn: connection taken by get_connection
+        :param keep: False to close the connection, e.g. after an overload
+        :return: None
+        """
+        ctl = self.get_controller(sect)
+        with self._pool_lock:
+            idle = self._pools.setdefault(sect, [])
+            if keep and len(idle) < ctl.limit:
+                idle.append(conn)
+                return
+        self.close_connection(conn)
+
+    def close_connection(self, conn):
+        try:
+            conn.ftp_close()
+        except Exception as ex:
+            self.log.exception(ex)
+
+    def close_connections(self):
+        """
+        Close every pooled connection.
+
+        :return: None
+        """
+        with self._pool_lock:
+            pools = self._pools
+            self._pools = {}
+        for idle in pools.values():
+            for conn in idle:
+                self.close_connection(conn)
 
     def read_config_sections(self):
         """
@@ -349,18 +629,34 @@ class TdsRelay(object):
             self.log.exception(ex)
             self.log.error("Exception reading config file {0}, section {1}".format(self.config_file, section_name))
 
-    def choose_transmit_mode(self, mode, logfile, login, passwd, host, dir):
-        # Note: here we are dynamically load module using importlib and getattr,  REF: https://goo.gl/v2nyqs
-        # TODO: refactor to make it more general and less code. e.g. extracting string into argument of funciton.
+    def read_transport_options(self, section_name):
+        """
+        Return the keys written in a section beyond the common ones, as options of its transport,
+        e.g. chunk_size or window for SFTP, latency for MEMORY. Keys of [DEFAULT] are not options.
 
-        if mode == "FTP":
-            FtpWrapperImplClass = getattr(importlib.import_module("lib.relayftp"), "RelayFtp")
-            instance = FtpWrapperImplClass(host, login, passwd, dir)
-            return instance
-        else:
-            FtpWrapperImplClass = getattr(importlib.import_module("lib.relaysftp"), "RelaySftp")
-            instance = FtpWrapperImplClass(host, login, passwd, dir)
-            return instance
+        :param section_name: section of the .config.ini
+        :return: dict of option name to int, float or str value
+        """
+        conf = configparser.ConfigParser()
+        conf.read(self.config_file)
+        options = {}
+        defaults = conf.defaults()
+        for key in conf.options(section_name):
+            if key in SECTION_KEYS or key in defaults:  # a [DEFAULT] key is not a transport option
+                continue
+            value = conf.get(section_name, key)
+            for convert in (int, float):
+                try:
+                    value = convert(value)
+                    break
+                except ValueError:
+                    pass
+            options[key] = value
+        return options
+
+    def choose_transmit_mode(self, mode, logfile, login, passwd, host, dir, **options):
+        # Note: transports are looked up by mode in lib.relay_transport, which imports each module once
+        return create_transport(mode, host, login, passwd, dir, **options)
 
     def get_file_age_seconds(self, file):
         """
@@ -378,82 +674,18 @@ class TdsRelay(object):
             self.log.error("Exception getting file modification time for {0}".format(file))
         return age
 
-    def quarantine_file(self, file, forward_dir):
+    def quarantine_file(self, file, forward_dir, error=None, missing=None):
         """
-        Move file to non-processing folders to deal with later
+        Queue file to be moved to non-processing folders to deal with later.
+        The move itself is deferred to the post actions stage of forward_dir.
 
+        :param error: exception of the failed upload, recorded for the re-drive
+        :param missing: sections the file was not sent to, recorded for the re-drive
         """
-        quara = os.path.join(forward_dir, QUARANTINE)
-        if not os.path.exists(quara):
-            os.mkdir(quara)
-
-        if os.path.exists(file):
-            self.log.info("moved file to quarantine due to exception: {0} to {1} ".format(file,quara))
-            shutil.move(file, quara)
-
-
-    def remove_file(self, file):
-        """
-        Removes specified file while logging and swallowing any exceptions.
-
-        :param file: file being processed
-        :return: None
-        """
-        try:
-            os.unlink(file)
-        except Exception as ex:
-            self.log.exception(ex)
-            self.log.error("Unable to remove file {0}".format(file))
-        return
-
-    def get_customer_info_from_dat(self, file):
-        """
-        Find the text of node <DestinationFolder> from .dat/envelope.xml file .
-
-        :param file: file being processed
-        :return: None or text of <DestinationFolder/>
-        """
-        try:
-            z = zipfile.ZipFile(file, "r")
-            x = z.open("request.xml")
-            tree = ET.ElementTree(file=x)
-            z.close()
-            x.close()
-            target_node = ".//CustomerName"
-            if not any(a is None for a in [tree, tree.find(target_node)]):
-                return tree.find(target_node).text
-
-            err = "Cannot get customer info. from {0}".format(file)
-            raise TdsRelayUnmetSpecError(err)
-        except Exception as ex:
-            raise ex
-        finally:
-            if z:
-                z.close()
-            if x:
-                x.close()
-        return None
-
-    def validate_transfer_info(self, file):
-        """
-        check if the customer info is the same for configure and data file
-
-        :param file: file being processed
-        :return: boolean
-        """
-
-        ret = True
-        c_dat = self.get_customer_info_from_dat(file)
-        c_dat = '' if c_dat is None else str(c_dat)
-
-        # check all sections!
-        sections = self.read_config_sections()
-        for sect in sections:
-            (FTPmode, login, passwd, host, customers, dir) = self.read_config_ini(sect)
-            self.log.info("Validate config, customer from  section {0} of .ini : {1} , from .dat : {2} ".format(sect, customers, c_dat ))
-            if c_dat not in customer:
-                return False
-        return ret
+        if self.post_actions is None or self.post_actions.forward_dir != forward_dir:
+            self.post_actions = RelayPostActions(forward_dir)
+        self.log.info("queued file for quarantine due to exception: {0}".format(file))
+        self.post_actions.quarantine(file, error, missing)
 
 
 def get_log_name():
@@ -502,7 +734,40 @@ def parse_args():
     cl.add_argument("--all-pass", dest="is_all_pass",  action="store_true", required=False,
                     help="TDS relay shall send all files, default:false")
     cl.add_argument("--delay", dest="transfer_delay",  nargs='?', const=120, type=int, required=False, default=120,
-                    help="TDS relay shall delay transfer in second, default:120s")
+                    help="TDS relay shall delay transfer in second, default:120s.\n"
+                         "With readiness detection, the longest wait of a file which cannot be proven complete, 0 never")
+    cl.add_argument("--no-readiness", dest="is_no_readiness", action="store_true", required=False,
+                    help="TDS relay shall only wait the delay, instead of releasing files once provably complete, default:false")
+    cl.add_argument("--tmp-rename", dest="is_tmp_rename", action="store_true", required=False,
+                    help="TDS writes files as .tmp and renames them when done, so any other file is complete, default:false")
+    cl.add_argument("--log-level", dest="log_level", choices=LOG_LEVELS, required=False, default="INFO",
+                    help="TDS relay log level, default:INFO")
+    cl.add_argument("--file-log-level", dest="file_log_level", choices=LOG_LEVELS, required=False, default="DEBUG",
+                    help="Level of per-file records (forwarding, renaming, backup...), default:DEBUG")
+    cl.add_argument("--json-log", dest="is_json_log", action="store_true", required=False,
+                    help="TDS relay shall write the log as JSON lines, default:false")
+    cl.add_argument("--lease-ttl", dest="lease_ttl", type=int, required=False, default=DEFAULT_TTL,
+                    help="Seconds before a forward folder lease of a crashed instance is reclaimed, default:{0}s".format(DEFAULT_TTL))
+    cl.add_argument("--validate-workers", dest="validate_workers", type=int, required=False, default=2,
+                    help="Number of chunks of .dat files validated at once, at least the validate processes, default:2")
+    cl.add_argument("--upload-workers", dest="upload_workers", type=int, required=False, default=1,
+                    help="Number of threads uploading, each with its own connections, default:1")
+    cl.add_argument("--validate-processes", dest="validate_processes", type=int, required=False, default=None,
+                    help="Processes validating .dat files, 0 or 1 validates in threads, default:number of CPUs")
+    cl.add_argument("--validate-chunk", dest="validate_chunk", type=int, required=False, default=32,
+                    help="Files sent at once to a validating process, default:32")
+    cl.add_argument("--queue-depth", dest="queue_depth", type=int, required=False, default=64,
+                    help="Depth of the bounded queue in front of each pipeline stage, default:64")
+    cl.add_argument("--min-connections", dest="min_connections", type=int, required=False, default=1,
+                    help="Lowest number of parallel uploads per host, default:1")
+    cl.add_argument("--max-connections", dest="max_connections", type=int, required=False, default=None,
+                    help="Highest number of parallel uploads per host, tuned in between automatically, at most and by default:upload workers")
+    cl.add_argument("--redrive-max-attempts", dest="redrive_max_attempts", type=int, required=False, default=MAX_ATTEMPTS,
+                    help="Attempts of a file quarantined for a transient cause before leaving it for manual handling, 0 disables the re-drive, default:{0}".format(MAX_ATTEMPTS))
+    cl.add_argument("--redrive-delay", dest="redrive_base_delay", type=int, required=False, default=BASE_DELAY,
+                    help="Seconds before the first re-drive of a quarantined file, doubled after each attempt, default:{0}s".format(BASE_DELAY))
+    cl.add_argument("--global-lock", dest="is_global_lock", action="store_true", required=False,
+                    help="TDS relay shall run as the only instance for the root dir instead of leasing each folder, default:false")
 
     args = cl.parse_args()
     return args
@@ -543,52 +808,65 @@ def main():
     """
     Main method for utility to convert PDL files to TXT files.
     """
+    args = parse_args()
     create_log_dir()
     logfile = get_log_name()
-    logging.basicConfig(filename=logfile, level=logging.INFO, format=LOG_FMT)
+    setup_logging(logfile,
+                  level=logging.getLevelName(args.log_level),
+                  file_event_level=logging.getLevelName(args.file_log_level),
+                  structured=args.is_json_log)
     log = logging.getLogger(__name__)
 
     dtstr = datetime.now().isoformat()[:-7]
     log.info("***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***")
     log.info("***  {0}.py (version {1}) -- Launched {2}".format(PRG_NAM, __version__, dtstr))
     log.info("***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***")
-    get_lock_or_exit(log)
+    if args.is_global_lock:
+        get_lock_or_exit(log)
 
     try:
-        args = parse_args()
         log.info("is_search_root".ljust(50) + ("YES" if args.is_search_root  else "NO") )
         log.info("is_no_validate_customer".ljust(50) + ("YES" if args.is_no_validate_customer  else "NO") )
         log.info("is_backup_when_succeed".ljust(50) + ("YES" if args.is_search_root  else "NO") )
         log.info("is_all_pass".ljust(50) + ("YES" if args.is_all_pass  else "NO") )
         log.info("transfer_delay".ljust(50) + str(args.transfer_delay) + " seconds" )
+        log.info("readiness".ljust(50) + ("NO" if args.is_no_readiness else "YES") )
         forwarder = TdsRelay(args.rdir,
                              args.is_search_root,
                              args.is_no_validate_customer,
                              args.is_backup_when_succeed,
                              args.is_all_pass,
-                             args.transfer_delay)
+                             args.transfer_delay,
+                             not args.is_global_lock,
+                             args.lease_ttl,
+                             args.validate_workers,
+                             args.upload_workers,
+                             args.queue_depth,
+                             args.min_connections,
+                             args.max_connections,
+                             args.redrive_max_attempts,
+                             args.redrive_base_delay,
+                             args.validate_processes,
+                             args.validate_chunk,
+                             not args.is_no_readiness,
+                             args.is_tmp_rename)
         forwarder.run()
     except Exception as ex:
         log.error(ex)
 
     finally:
-        release_lock(log)
+        if args.is_global_lock:
+            release_lock(log)
         log.info("\nSee log file for details ({0}).\n".format(logfile))
         dtstr = datetime.now().isoformat()[:-7]
         log.info("***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***")
         log.info("***  {0}.py (version {1}) -- Terminated {2}".format(PRG_NAM, __version__, dtstr))
         log.info("***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***  ***")
+        stop_logging()
         logging.shutdown()
 
         sys.exit()
 
-# Python code t get difference of two lists
-# Not using set()
-def diff_of_lists(li1, li2):
-    li_dif = [i for i in li1 + li2 if i not in li1 or i not in li2]
-    return li_dif
-
-
 # Python boilerplate idiom to call the main() function.
 if __name__ == '__main__':
     main()